@@ -13,7 +13,7 @@
     'website': "http://www.yourcompany.com",
 
     'category': 'Technical',
-    'version': '0.9',
+    'version': '0.10',
 
     # any module necessary for this one to work correctly
     'depends': ['base'],
@@ -29,9 +29,11 @@
         'views/external_data_object.xml',
         'views/external_data_field_mapping.xml',
         'views/external_data_rule.xml',
+        'views/external_data_lookup_table.xml',
         'views/external_data_strategy.xml',
         'views/external_data_menus.xml',
         'views/external_data_wizard.xml',
         'actions/external_data_actions.xml',
+        'data/external_data_cron.xml',
     ],
 }
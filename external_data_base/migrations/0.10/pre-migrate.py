@@ -0,0 +1,92 @@
+# coding: utf-8
+
+import logging
+_logger = logging.getLogger(__name__)
+
+OBJECT_RESOURCE_REL = 'external_data_object_external_data_resource_rel'
+OBJECT_LINK_REL = 'external_data_object_external_data_object_link_rel'
+
+
+def migrate(cr, version):
+    """Consolidates duplicated external objects and object links
+    before their unique constraint and indexes get created."""
+    if not version:
+        return
+    _consolidate_objects(cr)
+    _consolidate_links(cr)
+
+
+def _merge_rel(cr, rel, column, other_column, dup_table):
+    """Moves relation rows of duplicates to the kept records."""
+    cr.execute(f"""
+        INSERT INTO {rel} ({column}, {other_column})
+        SELECT d.keep_id, r.{other_column}
+        FROM {rel} r JOIN {dup_table} d ON d.id = r.{column}
+        ON CONFLICT DO NOTHING
+    """)
+    cr.execute(f"""
+        DELETE FROM {rel} r USING {dup_table} d WHERE d.id = r.{column}
+    """)
+
+
+def _consolidate_objects(cr):
+    cr.execute("""
+        CREATE TEMPORARY TABLE external_data_object_dup AS
+        SELECT o.id, d.keep_id
+        FROM external_data_object o
+        JOIN (
+            SELECT data_source_id, foreign_type_id, foreign_id,
+                MIN(id) AS keep_id
+            FROM external_data_object
+            WHERE data_source_id IS NOT NULL
+            GROUP BY data_source_id, foreign_type_id, foreign_id
+            HAVING COUNT(*) > 1
+        ) d USING (data_source_id, foreign_type_id, foreign_id)
+        WHERE o.id != d.keep_id
+    """)
+    cr.execute("SELECT COUNT(*) FROM external_data_object_dup")
+    count = cr.fetchone()[0]
+    if count:
+        _merge_rel(cr, OBJECT_RESOURCE_REL, 'external_data_object_id',
+                   'external_data_resource_id', 'external_data_object_dup')
+        _merge_rel(cr, OBJECT_LINK_REL, 'external_data_object_id',
+                   'external_data_object_link_id', 'external_data_object_dup')
+        for table in ['external_data_object_relation', 'external_data_rule']:
+            cr.execute(f"""
+                UPDATE {table} t SET object_id = d.keep_id
+                FROM external_data_object_dup d WHERE t.object_id = d.id
+            """)
+        cr.execute("""
+            DELETE FROM external_data_object o
+            USING external_data_object_dup d WHERE o.id = d.id
+        """)
+        _logger.info(f"Merged {count} duplicated external objects")
+    cr.execute("DROP TABLE external_data_object_dup")
+
+
+def _consolidate_links(cr):
+    cr.execute("""
+        CREATE TEMPORARY TABLE external_data_object_link_dup AS
+        SELECT l.id, d.keep_id
+        FROM external_data_object_link l
+        JOIN (
+            SELECT model_id, record_id, COALESCE(variant_tag, '') AS tag,
+                MIN(id) AS keep_id
+            FROM external_data_object_link
+            GROUP BY model_id, record_id, COALESCE(variant_tag, '')
+            HAVING COUNT(*) > 1
+        ) d ON d.model_id = l.model_id AND d.record_id = l.record_id
+            AND d.tag = COALESCE(l.variant_tag, '')
+        WHERE l.id != d.keep_id
+    """)
+    cr.execute("SELECT COUNT(*) FROM external_data_object_link_dup")
+    count = cr.fetchone()[0]
+    if count:
+        _merge_rel(cr, OBJECT_LINK_REL, 'external_data_object_link_id',
+                   'external_data_object_id', 'external_data_object_link_dup')
+        cr.execute("""
+            DELETE FROM external_data_object_link l
+            USING external_data_object_link_dup d WHERE l.id = d.id
+        """)
+        _logger.info(f"Merged {count} duplicated object links")
+    cr.execute("DROP TABLE external_data_object_link_dup")
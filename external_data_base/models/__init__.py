@@ -6,5 +6,6 @@ from . import external_data_object
 from . import external_data_transporter
 from . import external_data_serializer
 from . import external_data_field_mapping
+from . import external_data_lookup_table
 from . import external_data_rule
 from . import external_data_strategy
@@ -0,0 +1,191 @@
+# coding: utf-8
+
+import csv
+from base64 import b64decode
+from io import StringIO
+
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+from odoo.tools.lru import LRU
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class ExternalDataLookupTable(models.Model):
+    _name = 'external.data.lookup.table'
+    _description = "External Data Lookup Table"
+
+    name = fields.Char(required=True)
+    value_type = fields.Selection(
+        string="Value type",
+        selection=[
+            ('str', "string"),
+            ('int', "integer"),
+            ('float', "float"),
+        ],
+        required=True,
+        default='str',
+    )
+    cache_size = fields.Integer(
+        "Cache size",
+        help="Maximum number of entries kept in memory during a run.",
+        default=10000,
+    )
+    line_ids = fields.One2many(
+        'external.data.lookup.table.line',
+        inverse_name='table_id',
+        string="Lines",
+    )
+    line_count = fields.Integer(compute='_compute_line_count')
+    rule_ids = fields.One2many(
+        'external.data.rule',
+        inverse_name='lookup_table_id',
+        string="Rules",
+    )
+    import_file = fields.Binary("CSV file", attachment=False)
+    import_filename = fields.Char("CSV file name")
+    import_delimiter = fields.Char("Delimiter", default=",")
+    import_header = fields.Boolean("Skip header", default=True)
+    import_replace = fields.Boolean(
+        "Replace lines",
+        help="Delete all lines before import. "
+        "If unset, existing keys get updated.",
+        default=True,
+    )
+
+    @api.depends('line_ids')
+    def _compute_line_count(self):
+        table_lines = self.env['external.data.lookup.table.line']
+        counts = {
+            data['table_id'][0]: data['table_id_count']
+            for data in table_lines.read_group(
+                [('table_id', 'in', self.ids)], ['table_id'], ['table_id'])
+        }
+        for record in self:
+            record.line_count = counts.get(record.id, 0)
+
+    def button_import_csv(self):
+        for record in self:
+            if not record.import_file:
+                raise UserError("Please upload a CSV file first")
+            count = record.import_csv(
+                b64decode(record.import_file),
+                delimiter=record.import_delimiter or ",",
+                header=record.import_header,
+                replace=record.import_replace,
+            )
+            _logger.info(
+                f"Imported {count} lines to lookup table {record.name}")
+            record.write({'import_file': False, 'import_filename': False})
+
+    def import_csv(self, data, delimiter=",", header=True, replace=True,
+                   encoding='utf-8-sig'):
+        """Imports key/value pairs from the first two columns of a CSV,
+        returns the number of imported keys."""
+        self.ensure_one()
+        if isinstance(data, bytes):
+            data = data.decode(encoding)
+        reader = csv.reader(StringIO(data), delimiter=delimiter)
+        if header:
+            next(reader, None)
+        lines = {row[0]: row[1] for row in reader if len(row) > 1 and row[0]}
+        count = len(lines)
+
+        table_lines = self.env['external.data.lookup.table.line']
+        if replace:
+            self.line_ids.unlink()
+        else:
+            existing = table_lines.search([
+                ('table_id', '=', self.id),
+                ('key', 'in', list(lines.keys())),
+            ])
+            # one write per distinct value
+            existing_by_value = {}
+            for line in existing:
+                value = lines.pop(line.key)
+                if line.value != value:
+                    existing_by_value.setdefault(value, table_lines)
+                    existing_by_value[value] += line
+            for value, value_lines in existing_by_value.items():
+                value_lines.write({'value': value})
+
+        for lines_split in split_every(1000, lines.items()):
+            table_lines.create([
+                {'table_id': self.id, 'key': key, 'value': value}
+                for key, value in lines_split
+            ])
+        return count
+
+    def lookup(self, key, cache=None):
+        """Returns the value stored for a key converted to the value type,
+        None if the key is not found.
+        'cache' is an optional dict kept for a run, holding a bounded
+        LRU cache for each table."""
+        self.ensure_one()
+        key = str(key)
+        table_cache = None
+        if cache is not None:
+            table_cache = cache.get(self.id)
+            if table_cache is None:
+                table_cache = cache[self.id] = LRU(max(self.cache_size, 1))
+            if key in table_cache:
+                return table_cache[key]
+
+        self.env['external.data.lookup.table.line'].flush(
+            ['table_id', 'key', 'value'])
+        self.env.cr.execute(
+            "SELECT value FROM external_data_lookup_table_line "
+            "WHERE table_id = %s AND key = %s",
+            (self.id, key),
+        )
+        row = self.env.cr.fetchone()
+        value = self._convert_value(row[0]) if row else None
+        if table_cache is not None:
+            table_cache[key] = value
+        return value
+
+    def _convert_value(self, value):
+        self.ensure_one()
+        if self.value_type == 'str' or value is None:
+            return value
+        try:
+            if self.value_type == 'int':
+                return int(value)
+            elif self.value_type == 'float':
+                return float(value)
+        except ValueError as e:
+            _logger.error(e)
+            return None
+
+    def list_lines(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': 'Lookup table lines',
+            'view_mode': 'tree',
+            'res_model': 'external.data.lookup.table.line',
+            'domain': [('table_id', '=', self.id)],
+            'context': {'default_table_id': self.id},
+        }
+
+
+class ExternalDataLookupTableLine(models.Model):
+    _name = 'external.data.lookup.table.line'
+    _description = "External Data Lookup Table Line"
+    _order = 'key'
+
+    table_id = fields.Many2one(
+        'external.data.lookup.table',
+        string="Lookup table",
+        required=True,
+        ondelete='cascade',
+    )
+    key = fields.Char(required=True)
+    value = fields.Char()
+
+    _sql_constraints = [
+        ('key_uniq', 'unique(table_id, key)',
+         "Keys have to be unique within a lookup table!"),
+    ]
@@ -1,12 +1,15 @@
 # coding: utf-8
 
+import json
 import re
 
 from datetime import datetime
-from odoo import api, fields, models
+from odoo import api, fields, models, tools
 from odoo.exceptions import MissingError, UserError
 from odoo.fields import Command
-from odoo.tools import image
+from odoo.tools import image, split_every
+
+from ..tools import binary_cache, fetcher
 
 import logging
 _logger = logging.getLogger(__name__)
@@ -72,6 +75,18 @@ class ExternalDataObject(models.Model):
         domain=[('pre_post', '=', 'post')],
     )
     last_sync = fields.Datetime("Last sync")
+    vals_hashes = fields.Text(
+        "Values hashes",
+        help="JSON map of the hashes of the values last written "
+        "by each field mapping.",
+        copy=False,
+    )
+
+    _sql_constraints = [
+        ('foreign_id_uniq',
+         'unique(data_source_id, foreign_type_id, foreign_id)',
+         "Foreign IDs have to be unique within a data source and type!"),
+    ]
 
     @api.depends('object_link_ids')
     def _compute_link_count(self):
@@ -83,6 +98,12 @@ class ExternalDataObject(models.Model):
         for record in self:
             record.name = record.foreign_id
 
+    def init(self):
+        # lookups of similar objects across data sources
+        tools.create_index(
+            self._cr, 'external_data_object_foreign_id_index',
+            self._table, ['foreign_type_id', 'foreign_id'])
+
     def get_object_link(self, model_id, variant_tag=False):
         self.ensure_one()
         object_link = self.object_link_ids.filtered(
@@ -103,19 +124,138 @@ class ExternalDataObject(models.Model):
     def _record(self, model_id, variant_tag=False):
         return self.get_object_link(model_id, variant_tag)._record()
 
+    @api.model
+    def get_object_index(self, data_source_id, foreign_type_id):
+        """Returns external object IDs of a data source and foreign type
+        in a dict keyed by (foreign_type_id, foreign_id).
+        Built with a single query, meant to be kept for a whole run."""
+        self.flush(['data_source_id', 'foreign_type_id', 'foreign_id'])
+        self.env.cr.execute(
+            "SELECT foreign_type_id, foreign_id, id "
+            "FROM external_data_object "
+            "WHERE data_source_id = %s AND foreign_type_id = %s",
+            (data_source_id, foreign_type_id),
+        )
+        return {
+            (foreign_type_id, foreign_id): object_id
+            for foreign_type_id, foreign_id, object_id
+            in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def insert_or_fetch(self, vals):
+        """Inserts an external object unless one exists with the same
+        foreign ID, letting the unique constraint arbitrate between
+        concurrent workers. Returns the object and whether it was inserted
+        by this call. A conflict with an object committed after the
+        snapshot of the transaction raises a serialization failure:
+        the pull has to be retried in a new transaction."""
+        self.flush(['data_source_id', 'foreign_type_id', 'foreign_id'])
+        key = (vals['data_source_id'], vals['foreign_type_id'],
+               vals['foreign_id'])
+        self.env.cr.execute("""
+            INSERT INTO external_data_object (
+                data_source_id, foreign_type_id, foreign_id, priority,
+                create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s,
+                %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT (data_source_id, foreign_type_id, foreign_id)
+            DO NOTHING
+            RETURNING id
+        """, key + (vals.get('priority', 10), self.env.uid, self.env.uid))
+        row = self.env.cr.fetchone()
+        inserted = bool(row)
+        if not inserted:
+            self.env.cr.execute(
+                "SELECT id FROM external_data_object "
+                "WHERE data_source_id = %s AND foreign_type_id = %s "
+                "AND foreign_id = %s", key)
+            row = self.env.cr.fetchone()
+        ext_object = self.browse(row[0])
+        if vals.get('resource_ids'):
+            ext_object.resource_ids = vals['resource_ids']
+        return ext_object, inserted
+
+    @api.model
+    def purge_orphans(self, object_ids=None):
+        """Deletes external objects referenced by no resource (and having
+        no rules), then object links left without objects, optionally
+        among the given object IDs only. Linked records are kept.
+        Returns the number of deleted objects and links."""
+        resource_field = self._fields['resource_ids']
+        link_field = self._fields['object_link_ids']
+        self.flush()
+        query = f"""
+            SELECT o.id FROM external_data_object o
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {resource_field.relation} r
+                WHERE r.{resource_field.column1} = o.id
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM external_data_rule rule
+                WHERE rule.object_id = o.id
+            )
+        """
+        params = []
+        if object_ids is not None:
+            query += " AND o.id = ANY(%s)"
+            params.append(list(object_ids))
+        self.env.cr.execute(query, params)
+        orphans = self.browse([row[0] for row in self.env.cr.fetchall()])
+        link_ids = set()
+        if orphans:
+            self.env.cr.execute(
+                f"SELECT {link_field.column2} FROM {link_field.relation} "
+                f"WHERE {link_field.column1} = ANY(%s)",
+                (orphans.ids,),
+            )
+            link_ids = {row[0] for row in self.env.cr.fetchall()}
+            orphans.unlink()
+
+        link_query = f"""
+            SELECT l.id FROM external_data_object_link l
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {link_field.relation} r
+                WHERE r.{link_field.column2} = l.id
+            )
+        """
+        link_params = []
+        if object_ids is not None:
+            if not link_ids:
+                return len(orphans), 0
+            link_query += " AND l.id = ANY(%s)"
+            link_params.append(list(link_ids))
+        self.env.cr.execute(link_query, link_params)
+        links = self.env['external.data.object.link'].browse(
+            [row[0] for row in self.env.cr.fetchall()])
+        links.unlink()
+        _logger.info(
+            f"Purged {len(orphans)} orphan objects and {len(links)} links")
+        return len(orphans), len(links)
+
     def write_odoo_record(self, vals, metadata):
         self.ensure_one()
         model_id = metadata.get('model_id')
         model_model = metadata.get('model_model')
         variant_tag = metadata.get('obj_link_variant_tag', False)
         object_link = self.get_object_link(model_id, variant_tag)
+        field_mapping_id = metadata.get('field_mapping_id')
         if object_link:
-            self.sanitize_values(vals, prune_false=False, **metadata)
             record = object_link._record()
-            record.write(vals)
+            checksums = self.get_binary_checksums(record, field_mapping_id)
+            self.sanitize_values(vals, prune_false=False,
+                                 binary_checksums=checksums, **metadata)
+            update_buffer = metadata.get('update_buffer')
+            if update_buffer is not None:
+                self._buffer_write(update_buffer, record, vals)
+            else:
+                record.write(vals)
             object_link._compute_name()
+            self.set_binary_checksums(field_mapping_id, checksums)
         elif model_id and model_model:
-            if self.sanitize_values(vals, **metadata):
+            checksums = {}
+            if self.sanitize_values(
+                    vals, binary_checksums=checksums, **metadata):
                 record = self.env[model_model].create(vals)
                 object_link = object_link.create({
                     'model_id': model_id,
@@ -123,6 +263,7 @@ class ExternalDataObject(models.Model):
                     'variant_tag': variant_tag,
                 })
                 self.object_link_ids = [Command.link(object_link.id)]
+                self.set_binary_checksums(field_mapping_id, checksums)
             else:
                 _logger.error(
                     "Provided values are not sufficient "
@@ -134,9 +275,57 @@ class ExternalDataObject(models.Model):
             )
         self.last_sync = datetime.now()
 
+    def get_vals_hashes(self):
+        self.ensure_one()
+        return json.loads(self.vals_hashes or '{}')
+
+    def set_vals_hashes(self, **hashes):
+        self.ensure_one()
+        vals_hashes = self.get_vals_hashes()
+        vals_hashes.update(hashes)
+        self.vals_hashes = json.dumps(vals_hashes, sort_keys=True)
+
+    @api.model
+    def _buffer_write(self, update_buffer, record, vals):
+        """Merges vals into the buffered update of a record,
+        x2many commands are appended."""
+        buffered = update_buffer.setdefault(record._name, {}).setdefault(
+            record.id, {})
+        for key, value in vals.items():
+            if isinstance(value, list) and \
+                    isinstance(buffered.get(key), list):
+                buffered[key] = buffered[key] + value
+            else:
+                buffered[key] = value
+
+    def get_binary_checksums(self, record, field_mapping_id):
+        """Returns the checksums of the source binaries last written
+        to a record by a field mapping, for fields still holding a value."""
+        if not (self and record):
+            return {}
+        self.ensure_one()
+        checksums = self.get_vals_hashes().get(f"{field_mapping_id}:binary")
+        if not checksums:
+            return {}
+        record = record.with_context(bin_size=True)
+        return {
+            name: checksum for name, checksum in checksums.items()
+            if name in record._fields and record[name]
+        }
+
+    def set_binary_checksums(self, field_mapping_id, checksums):
+        if not self:
+            return
+        self.ensure_one()
+        key = f"{field_mapping_id}:binary"
+        if checksums != (self.get_vals_hashes().get(key) or {}):
+            self.set_vals_hashes(**{key: checksums})
+
     def link_similar_objects(self, model_id, **kwargs):
         """Tries to find similar objects in other data_sources by foreign_id,
-        sets on record if found, returns boolean."""
+        sets on record if found, returns boolean.
+        Links resolved in advance by resolve_similar_links() can be passed
+        in 'similar_links', keyed by (model_id, variant_tag)."""
         if not self:
             return False
         self.ensure_one()
@@ -147,40 +336,129 @@ class ExternalDataObject(models.Model):
         search_by_name = kwargs.get('search_link_by_name')
 
         # find similar types > objects > object links
-        object_link_domain = [
-            ('model_id.id', '=', model_id),
-            ('variant_tag', '=', variant_tag),
-        ]
         if search_by_name:
-            object_link_domain.append(('name', '=', search_by_name))
+            similar_links = self.resolve_links_by_name(
+                model_id, [search_by_name], variant_tag)
+            link_ids = similar_links[search_by_name]
         else:
-            similar_mapping_domain = [('model_id', '=', model_id)]
+            similar_links = False
             if not search_own_source:
-                similar_mapping_domain.append(
-                    ('data_source_id', '!=', self.data_source_id.id))
-            similar_type_ids = self.env['external.data.field.mapping'].search(
-                similar_mapping_domain).mapped('foreign_type_id').ids
-            similar_objs = self.search([
-                ('id', '!=', self.id),
-                ('foreign_id', '=', self.foreign_id),
-                ('foreign_type_id', 'in', similar_type_ids),
-            ])
-            object_link_domain.append(('object_ids', 'in', similar_objs.ids))
-
-        similar_object_links = self.object_link_ids.search(
-            object_link_domain).filtered(lambda r: r._record())
-        if not similar_object_links:
+                similar_links = kwargs.get('similar_links', {}).get(
+                    (model_id, variant_tag))
+            if not similar_links or self.foreign_id not in similar_links:
+                similar_type_ids = self.get_similar_type_ids(
+                    model_id, self.data_source_id.id,
+                    search_own_source=search_own_source,
+                    cache=kwargs.get('similar_type_ids'),
+                )
+                similar_links = self.resolve_similar_links(
+                    model_id, [self.foreign_id], similar_type_ids,
+                    variant_tag=variant_tag,
+                )
+            link_ids = [
+                link_id for object_id, link_id
+                in similar_links[self.foreign_id]
+                if object_id != self.id
+            ]
+        if not link_ids:
             return False
 
         _logger.info(
             "Adding similar object links ids to object "
-            f"ID {self.id}: {similar_object_links.ids}"
+            f"ID {self.id}: {link_ids}"
         )
-        self.object_link_ids = [
-            Command.link(link.id) for link in similar_object_links
-        ]
+        self.object_link_ids = [Command.link(i) for i in link_ids]
         return True
 
+    @api.model
+    def get_similar_type_ids(self, model_id, data_source_id,
+                             search_own_source=False, cache=None):
+        """Returns IDs of foreign types mapped to the same model,
+        by default in other data sources. Results are stored in the
+        optional 'cache' dict, so a run computes them only once."""
+        key = (model_id, data_source_id, bool(search_own_source))
+        if cache is not None and key in cache:
+            return cache[key]
+        similar_mapping_domain = [('model_id', '=', model_id)]
+        if not search_own_source:
+            similar_mapping_domain.append(
+                ('data_source_id', '!=', data_source_id))
+        similar_type_ids = self.env['external.data.field.mapping'].search(
+            similar_mapping_domain).mapped('foreign_type_id').ids
+        if cache is not None:
+            cache[key] = similar_type_ids
+        return similar_type_ids
+
+    @api.model
+    def resolve_similar_links(self, model_id, foreign_ids, foreign_type_ids,
+                              variant_tag=False):
+        """Resolves object links of live records for a set of foreign IDs
+        in one query per IN_MAX foreign IDs.
+        Returns a dict keyed by every requested foreign ID:
+        {foreign_id: [(object_id, object_link_id), ...]}"""
+        result = {foreign_id: [] for foreign_id in foreign_ids}
+        if not (result and foreign_type_ids):
+            return result
+
+        self.flush()
+        rel_field = self._fields['object_link_ids']
+        query = (
+            "SELECT o.foreign_id, o.id, l.id, l.record_id "
+            "FROM external_data_object o "
+            f"JOIN {rel_field.relation} r ON r.{rel_field.column1} = o.id "
+            "JOIN external_data_object_link l "
+            f"ON l.id = r.{rel_field.column2} "
+            "WHERE o.foreign_type_id IN %s AND o.foreign_id IN %s "
+            "AND l.model_id = %s AND COALESCE(l.variant_tag, '') = %s"
+        )
+        rows = []
+        for foreign_ids_split in split_every(self.env.cr.IN_MAX, result):
+            self.env.cr.execute(query, (
+                tuple(foreign_type_ids), tuple(foreign_ids_split),
+                model_id, variant_tag or '',
+            ))
+            rows += self.env.cr.fetchall()
+
+        live_ids = self._live_record_ids(model_id, [row[3] for row in rows])
+        for foreign_id, object_id, link_id, record_id in rows:
+            if record_id in live_ids:
+                result[foreign_id].append((object_id, link_id))
+        return result
+
+    @api.model
+    def resolve_links_by_name(self, model_id, names, variant_tag=False):
+        """Resolves object links of live records by name.
+        Returns a dict keyed by every requested name:
+        {name: [object_link_id, ...]}"""
+        result = {name: [] for name in names}
+        if not result:
+            return result
+
+        self.flush()
+        query = (
+            "SELECT name, id, record_id FROM external_data_object_link "
+            "WHERE name IN %s AND model_id = %s "
+            "AND COALESCE(variant_tag, '') = %s"
+        )
+        rows = []
+        for names_split in split_every(self.env.cr.IN_MAX, result):
+            self.env.cr.execute(
+                query, (tuple(names_split), model_id, variant_tag or ''))
+            rows += self.env.cr.fetchall()
+
+        live_ids = self._live_record_ids(model_id, [row[2] for row in rows])
+        for name, link_id, record_id in rows:
+            if record_id in live_ids:
+                result[name].append(link_id)
+        return result
+
+    @api.model
+    def _live_record_ids(self, model_id, record_ids):
+        if not record_ids:
+            return set()
+        model_model = self.env['ir.model'].browse(model_id).model
+        return set(self.env[model_model].browse(set(record_ids)).exists().ids)
+
     def healthcheck(self):
         """Delete empty object links, try to find valid ones."""
         for record in self:
@@ -201,16 +479,46 @@ class ExternalDataObject(models.Model):
             # TODO: sanitize push values
             pass
 
+    @api.model
+    @tools.ormcache('self.env.uid', 'model_model')
+    def _get_sanitize_plan(self, model_model):
+        """Returns what sanitize_values needs to know about a model:
+        field types, the field class of binary fields and the required
+        fields without default value. Computed once per model and user,
+        the registry cache is cleared on registry reload."""
+        model = self.env[model_model].with_context({
+            key: value for key, value in self.env.context.items()
+            if not key.startswith('default_')
+        })
+        fields_data = model.fields_get(attributes=['type', 'required'])
+        fields_with_default = model.default_get(list(fields_data)).keys()
+        field_types = {
+            name: data.get('type') for name, data in fields_data.items()
+        }
+        return {
+            'types': field_types,
+            'binary': {
+                name: model._fields[name].__class__.__name__
+                for name, ttype in field_types.items()
+                if ttype == 'binary' and name in model._fields
+            },
+            'required': tuple(
+                name for name, data in fields_data.items()
+                if data.get('required') and
+                name not in fields_with_default and
+                data.get('type') not in ['one2many', 'many2many']  # TODO: ???
+            ),
+        }
+
     @api.model
     def _sanitize_vals_pull(self, vals, model_model, prune_false=True,
-                            quiet=False, **kw):
-        model = self.env[model_model]
-        fields_data = model.fields_get()
-        fields_keys = list(fields_data.keys())
+                            quiet=False, binary_checksums=None, **kw):
+        plan = self._get_sanitize_plan(model_model)
+        field_types = plan['types']
         vals_copy = vals.copy()  # can't pop from the iterated dict
         for key, value in vals_copy.items():
             # drop irrelevant item
-            if key not in fields_keys or (prune_false and not value):
+            if key not in field_types or (prune_false and not value):
                 vals.pop(key)
                 continue
 
@@ -219,23 +527,21 @@ class ExternalDataObject(models.Model):
                 value = self._recordset_to_int_list(value)
 
             # check value by type
-            field_data = fields_data[key]
-            ttype = field_data.get('type')
+            ttype = field_types[key]
             if ttype in ['many2one', 'one2many', 'many2many']:
                 self._sanitize_relational(ttype, key, value, vals)
             elif ttype == 'binary':
-                self._sanitize_binary(model, key, value, vals)
+                field_classname = plan['binary'].get(key)
+                self._sanitize_binary(
+                    field_classname, key, value, vals,
+                    checksums=binary_checksums,
+                    processed=kw.get('image_cache'),
+                )
 
         # check required
-        fields_with_default = model.default_get(fields_keys).keys()
-        for name, data in fields_data.items():
-            conditions = [
-                name not in vals.keys(),
-                data.get('required'),
-                name not in fields_with_default,
-                data.get('type') not in ['one2many', 'many2many'],  # TODO: ???
-            ]
-            if all(conditions):
+        context = self.env.context
+        for name in plan['required']:
+            if name not in vals and 'default_' + name not in context:
                 quiet or _logger.warning(
                     f"Missing required field of model {model_model}: {name}"
                 )
@@ -281,14 +587,53 @@ class ExternalDataObject(models.Model):
                 vals.pop(key)
 
     @api.model
-    def _sanitize_binary(self, model, key, value, vals):
-        model_dict = model.__class__.__dict__
-        field_classname = model_dict[key].__class__.__name__
+    def resolve_pending_binaries(self, vals, model_model, checksums=None,
+                                 processed=None):
+        """Replaces binaries being fetched in vals by their sanitized
+        content, drops the ones failed to fetch. Returns vals.
+        See _sanitize_binary() for 'checksums' and 'processed'."""
+        plan = self._get_sanitize_plan(model_model)
+        for key, value in list(vals.items()):
+            if not isinstance(value, fetcher.PendingBinary):
+                continue
+            content = value.result()
+            if content is None:
+                vals.pop(key)
+                continue
+            vals[key] = content
+            self._sanitize_binary(
+                plan['binary'].get(key), key, content, vals,
+                checksums=checksums, processed=processed,
+            )
+        return vals
+
+    @api.model
+    def _sanitize_binary(self, field_classname, key, value, vals,
+                         checksums=None, processed=None):
+        """'checksums' maps fields to the checksum of the source image
+        the record holds: unchanged images are dropped from vals, the
+        dict gets updated with the new ones. 'processed' is a cache of
+        processed images by source checksum."""
+        if isinstance(value, fetcher.PendingBinary):
+            return  # sanitized once resolved
         if field_classname == 'Image':
             if isinstance(value, str) or isinstance(value, bytes):
+                source_checksum = None
+                if checksums is not None or processed is not None:
+                    source_checksum = binary_cache.checksum(value)
+                if checksums and checksums.get(key) == source_checksum:
+                    vals.pop(key)  # the record holds it already
+                    return
                 try:
-                    img = image.image_process(value)
+                    if processed is not None and source_checksum in processed:
+                        img = processed[source_checksum]
+                    else:
+                        img = image.image_process(value)
+                        if processed is not None:
+                            processed[source_checksum] = img
                     vals[key] = img
+                    if checksums is not None:
+                        checksums[key] = source_checksum
                 except UserError as e:
                     _logger.error(e)
                     vals.pop(key)
@@ -374,6 +719,11 @@ class ExternalDataObjectLink(models.Model):
               "It comaes from the field mapping.")
     )
 
+    def init(self):
+        tools.create_index(
+            self._cr, 'external_data_object_link_record_index',
+            self._table, ['model_id', 'record_id', 'variant_tag'])
+
     @api.depends('model_id', 'record_id')
     def _compute_name(self):
         for record in self:
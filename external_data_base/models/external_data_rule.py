@@ -1,12 +1,12 @@
 # coding: utf-8
 
 import re
-import requests
+from string import Formatter
 from base64 import b64encode
 from time import strptime, mktime
 from datetime import datetime
 
-from odoo import api, fields, models
+from odoo import api, fields, models, tools
 from odoo.exceptions import ValidationError
 
 # may be used in user input
@@ -86,7 +86,8 @@ class ExternalDataRule(models.Model):
             ('clear', "Set value to 'False'"),
             ('replace', "Replace value with re.sub(pattern, repl, count)"),
             ('parse_time', "Parse time by pattern with time.strptime"),
-            ('hashtable', "Map parsed data as key to a hashtable"),
+            ('hashtable', "Map parsed data as key to a hashtable "
+             "or a lookup table"),
             ('lambda',
              "lambda expression evaluated to value ('v' in input)."
              "Other values can be injected in '{}' brackets."
@@ -123,6 +124,12 @@ class ExternalDataRule(models.Model):
     sub_repl = fields.Char()
     sub_count = fields.Integer()
     hashtable = fields.Text(default="{}")
+    lookup_table_id = fields.Many2one(
+        'external.data.lookup.table',
+        string="Lookup table",
+        help="If set, used instead of the hashtable.",
+        ondelete='restrict',
+    )
     parse_time_pattern = fields.Char("pattern")
     lambda_str = fields.Text("lambda v:")
     eval_str = fields.Text("eval")
@@ -156,6 +163,11 @@ class ExternalDataRule(models.Model):
         "Model",
     )
     fetch_binary_encode = fields.Boolean("Encode", default=True)
+    fetch_binary_batch = fields.Boolean(
+        "Batched",
+        help="Fetch concurrently with the other binaries of the chunk "
+        "of objects being pulled, and write them at the end of the chunk.",
+    )
     apply_field_mapping_id = fields.Many2one(
         'external.data.field.mapping',
         string="Field mapping",
@@ -196,6 +208,68 @@ class ExternalDataRule(models.Model):
         for record in self:
             record.operation_help = record.operation
 
+    @tools.ormcache('self.id', 'self.write_date')
+    def _get_compiled(self):
+        """Returns the compiled form of the rule: code objects of conditions
+        and expressions, pre-built lambdas and compiled regexes.
+        Cached by ID and last modification, so a modified rule gets
+        compiled again at first use."""
+        self.ensure_one()
+        _logger.debug(f"Compiling rule ID {self.id}")
+        compiled = {
+            'key': self.key,
+            'operation': self.operation,
+            'keep': self.keep,
+            'condition': None,
+            'eval': None,
+            'lambda': None,
+            'lambda_tmplt': False,
+            'pattern': None,
+            'hashtable': None,
+        }
+        if self.condition:
+            operator = self.condition_operator
+            if operator:
+                conditions = operator + "([" + self.condition + "])"
+            else:
+                conditions = "(" + self.condition + ")"
+            if self.condition_negate:
+                conditions = "not " + conditions
+            compiled['condition'] = self._compile_expr(conditions)
+        if self.operation == 'eval' and self.eval_str:
+            compiled['eval'] = self._compile_expr("(" + self.eval_str + ")")
+        elif self.operation == 'lambda' and self.lambda_str:
+            lambda_str = f"(lambda v: {self.lambda_str})"
+            if self._is_template(lambda_str):
+                # values injected from 'vals', compiled at runtime
+                compiled['lambda_tmplt'] = lambda_str
+            else:
+                compiled['lambda'] = self._get_lambda(lambda_str)
+        elif self.operation == 'replace':
+            compiled['pattern'] = re.compile(
+                self.sub_pattern or '^.*$', flags=re.DOTALL)
+        elif self.operation == 'hashtable' and self.hashtable:
+            compiled['hashtable'] = self._eval_expr(self.hashtable)
+        return compiled
+
+    @api.model
+    def _compile_expr(self, expr):
+        try:
+            return compile(expr, '<external.data.rule>', 'eval')
+        except SyntaxError:
+            _logger.error(f"Failed to compile expression: {expr}")
+            return compile('None', '<external.data.rule>', 'eval')
+
+    @api.model
+    def _is_template(self, template):
+        try:
+            return any(
+                field_name is not None
+                for _, field_name, _, _ in Formatter().parse(template)
+            )
+        except ValueError:
+            return True
+
     def apply_rules(self, vals, metadata={}):
         if not isinstance(vals, dict):
             raise ValidationError(
@@ -203,52 +277,52 @@ class ExternalDataRule(models.Model):
             )
 
         for rule in self:
-            metadata.update(key=rule.key)
-            if rule.condition:
-                operator = rule.condition_operator
-                if operator:
-                    conditions = operator + "([" + rule.condition + "])"
-                else:
-                    conditions = "(" + rule.condition + ")"
-                if rule.condition_negate:
-                    conditions = "not " + conditions
-                if not bool(rule._eval_expr(conditions, vals, metadata)):
+            compiled = rule._get_compiled()
+            key, operation = compiled['key'], compiled['operation']
+            metadata.update(key=key)
+            if compiled['condition'] is not None:
+                condition = rule._eval_code(
+                    compiled['condition'], vals, metadata)
+                if not bool(condition):
                     continue
-            if rule.operation == 'drop':
+            if operation == 'drop':
                 metadata.update(drop=True)
                 if rule.drop_delete:
                     metadata.update(delete=True)
                 return
 
-            value = vals.get(rule.key)
+            value = vals.get(key)
             result = None
-            if rule.operation == 'exclude':
-                if rule.key in vals.keys():
-                    vals.pop(rule.key)
-            elif rule.operation == 'clear':
+            if operation == 'exclude':
+                if key in vals.keys():
+                    vals.pop(key)
+            elif operation == 'clear':
                 result = False
-            elif rule.operation == 'replace':
+            elif operation == 'replace':
                 result = rule._regexp_replace(value, vals)
-            elif rule.operation == 'hashtable':
-                if rule.hashtable and value:
-                    hashtable = self._eval_expr(rule.hashtable)
-                    if isinstance(hashtable, dict):
-                        result = hashtable.get(value)
-                        if isinstance(result, type(None)):
-                            result = False
-            elif rule.operation == 'parse_time':
+            elif operation == 'hashtable':
+                hashtable = compiled['hashtable']
+                if rule.lookup_table_id and value:
+                    result = rule.lookup_table_id.lookup(
+                        value, cache=metadata.get('lookup_cache'))
+                    if isinstance(result, type(None)):
+                        result = False
+                elif isinstance(hashtable, dict) and value:
+                    result = hashtable.get(value)
+                    if isinstance(result, type(None)):
+                        result = False
+            elif operation == 'parse_time':
                 result = rule._parse_time(value)
-            elif rule.operation == 'lambda' and rule.lambda_str:
-                if rule.lambda_str:
-                    lambda_str = f"(lambda v: {rule.lambda_str})"
-                    f = rule._get_lambda(lambda_str, vals)
-                    if f:
-                        result = f(value)
-            elif rule.operation == 'eval':
-                if rule.eval_str:
-                    eval_str = "(" + rule.eval_str + ")"
-                    result = rule._eval_expr(eval_str, vals, metadata)
-            elif rule.operation == 'orm_ref' and rule.orm_ref:
+            elif operation == 'lambda':
+                f = compiled['lambda']
+                if compiled['lambda_tmplt']:
+                    f = rule._get_lambda(compiled['lambda_tmplt'], vals)
+                if f:
+                    result = f(value)
+            elif operation == 'eval':
+                if compiled['eval'] is not None:
+                    result = rule._eval_code(compiled['eval'], vals, metadata)
+            elif operation == 'orm_ref' and rule.orm_ref:
                 try:
                     record = rule.env.ref(rule.orm_ref)
                 except ValueError as e:
@@ -256,33 +330,48 @@ class ExternalDataRule(models.Model):
                     continue
                 if record:
                     result = record.id
-            elif rule.operation == 'orm_expr':
+            elif operation == 'orm_expr':
                 result = rule._orm_expr(value, vals)
-            elif rule.operation == 'object_link':
+            elif operation == 'object_link':
                 result = rule._search_object_link(value)
-            elif rule.operation == 'apply_field_mapping':
+            elif operation == 'apply_field_mapping':
                 result = rule.apply_field_mapping(value, metadata.copy())
-            elif rule.operation == 'fetch_binary':
-                result = rule._fetch_binary(value, rule.fetch_binary_encode)
-            elif rule.operation == 'message_post':
+            elif operation == 'fetch_binary':
+                binary_fetcher = metadata.get('binary_fetcher')
+                if rule.fetch_binary_batch and binary_fetcher:
+                    if isinstance(value, str):
+                        result = binary_fetcher.submit(
+                            value, encode=rule.fetch_binary_encode)
+                    else:
+                        _logger.error(f"Invalid URL: {value}")
+                else:
+                    transporter = rule.env[
+                        'external.data.transporter'].browse(
+                            metadata.get('transporter_id') or [])
+                    result = rule._fetch_binary(
+                        value, rule.fetch_binary_encode,
+                        session=transporter.get_session(),
+                        cache=transporter.get_binary_cache(),
+                    )
+            elif operation == 'message_post':
                 rule._message_post(value, vals)
 
-            if result is None and rule.operation != 'include':
+            if result is None and operation != 'include':
                 continue
             elif result is not None:
-                vals[rule.key] = result
-            if rule.keep:
+                vals[key] = result
+            if compiled['keep']:
                 if result is None:  # in case of operation 'include'
                     result = value
-                keep_key = metadata['foreign_type_name'] + '_' + rule.key
+                keep_key = metadata['foreign_type_name'] + '_' + key
                 if 'keep' not in metadata.keys():
                     metadata['keep'] = {keep_key: result}
                 else:
                     metadata['keep'][keep_key] = result
             if 'processed_keys' in metadata.keys():
-                metadata['processed_keys'].append(rule.key)
+                metadata['processed_keys'].append(key)
             else:
-                metadata['processed_keys'] = [rule.key]
+                metadata['processed_keys'] = [key]
 
     def _regexp_replace(self, value, vals, multiline=True):
         # TODO: add parameter sub_multiline
@@ -290,17 +379,13 @@ class ExternalDataRule(models.Model):
         if not value:
             value = ''
 
-        pattern = self.sub_pattern
         if multiline:
-            flags = re.DOTALL
-            if not pattern:
-                pattern = '^.*$'
+            pattern = self._get_compiled()['pattern']
         else:
-            flags = 0
-            pattern = re.compile(pattern) if pattern else '^.*$'
+            pattern = re.compile(self.sub_pattern or '^.*$')
         repl = self.sub_repl.format(**vals) if self.sub_repl else ''
         count = self.sub_count
-        return re.sub(pattern, repl, value, count=count, flags=flags)
+        return pattern.sub(repl, value, count=count)
 
     def _parse_time(self, value):
         self.ensure_one()
@@ -392,6 +477,15 @@ class ExternalDataRule(models.Model):
             _logger.error(f"Failed to evaluate expression: {expr}")
             return None
 
+    def _eval_code(self, code, vals={}, metadata={}):
+        """Evaluates a compiled expression in the same namespace
+        as _eval_expr() evaluates a string."""
+        return eval(code, globals(), {
+            'self': self,
+            'vals': vals,
+            'metadata': metadata,
+        })
+
     @api.model
     def _get_lambda(self, lambda_str, vals={}):
         if not isinstance(lambda_str, str):
@@ -412,12 +506,19 @@ class ExternalDataRule(models.Model):
         return False
 
     @api.model
-    def _fetch_binary(self, url, encode=True):
+    def _fetch_binary(self, url, encode=True, session=None, cache=None):
         if not isinstance(url, str):
             _logger.error(f"Invalid URL: {url}")
             return None
+        if session is None:
+            session = self.env['external.data.transporter'].get_session()
+        if cache is not None:
+            content = cache.fetch(url, session)
+            if content is None:
+                return None
+            return b64encode(content) if encode else content
         try:
-            res = requests.get(url)
+            res = session.get(url)
         except Exception as e:
             _logger.error(e)
             return None
@@ -3,16 +3,14 @@
 import gzip
 import json
 import jmespath
-from io import BufferedReader
 
 from odoo import api, fields, models
-from odoo.exceptions import UserError, ValidationError
+from odoo.exceptions import UserError
 from odoo.tools import etree
-from bs4 import BeautifulSoup
-from bs4 import element as bs_element
-from urllib.parse import parse_qsl
 
-from ..tools import bs
+from ..tools import csv as csv_tools
+from ..tools import parser
+from ..tools import payload
 from ..tools.jmespath import options as jmespath_options
 
 import logging
@@ -30,6 +28,7 @@ class ExternalDataSerializer(models.Model):
             ('bs', "BeautifulSoup"),
             ('lxml_etree', "lxml.etree"),
             ('csv', "CSV"),
+            ('xlsx', "XLSX"),
             ('qweb', "Qweb"),
             ('custom', "custom"),
         ],
@@ -37,7 +36,51 @@ class ExternalDataSerializer(models.Model):
         default='json',
     )
     pretty_print = fields.Boolean("Pretty print", default=True)
+    streaming = fields.Boolean(
+        "Streaming",
+        help="Parse the payload while reading it: top-level generator "
+        "directives yield matching elements one by one and processed "
+        "elements are discarded, so memory usage doesn't depend on the "
+        "size of the payload. Other kinds of top-level directives "
+        "are not supported in this mode. JSON payloads have to be arrays, "
+        "projected by a '[*]' top-level directive.",
+    )
+    single_pass = fields.Boolean(
+        "Single pass",
+        help="Extract all foreign types in a single traversal of the "
+        "payload: objects are pulled in document order instead of one "
+        "foreign type after the other, records created in deferred mode "
+        "are created at the end of the pull. Required to pull multiple "
+        "foreign types of a streamed payload.",
+    )
     lxml_root = fields.Char("lxml root element")
+    csv_dialect = fields.Selection(
+        selection=[
+            ('excel', "Excel (comma separated)"),
+            ('excel-tab', "Excel (tab separated)"),
+            ('unix', "Unix"),
+        ],
+        string="CSV dialect",
+        default='excel',
+    )
+    csv_delimiter = fields.Char(
+        "CSV delimiter", size=1,
+        help="Overrides the delimiter of the dialect.")
+    csv_quotechar = fields.Char(
+        "CSV quote character", size=1,
+        help="Overrides the quote character of the dialect.")
+    header_row = fields.Boolean(
+        "Header row",
+        default=True,
+        help="The first row holds the column names. Columns are selected "
+        "by name if set, by index (starting at 0) otherwise.",
+    )
+    encoding = fields.Char(default='utf-8')
+    render_chunk_size = fields.Integer(
+        "Render chunk size",
+        default=1000,
+        help="Number of CSV rows rendered at once.",
+    )
     qweb_template = fields.Many2one(
         'ir.ui.view',
         string="Qweb template",
@@ -102,6 +145,9 @@ class ExternalDataSerializer(models.Model):
         self.ensure_one()
         # TODO: check if data is bytes
         if self.packaging == 'gzip':
+            if hasattr(data, 'read'):
+                # decompressed incrementally while the parser reads
+                return gzip.GzipFile(fileobj=data, mode='rb')
             return gzip.decompress(data)
         return data
 
@@ -110,6 +156,42 @@ class ExternalDataSerializer(models.Model):
         self.ensure_one()
         return self.parser_line_ids.objects(data)
 
+    def parse_stream(self, data, foreign_type_ids=None):
+        """Returns a generator of (foreign type ID, object data) pairs,
+        optionally only of the given foreign types, in their order
+        unless parsing in a single pass."""
+        self.ensure_one()
+        return self.parser_line_ids.tagged_objects(
+            data, foreign_type_ids=foreign_type_ids,
+            single_pass=self.single_pass,
+        )
+
+    def _get_format_options(self):
+        self.ensure_one()
+        return {
+            'dialect': self.csv_dialect,
+            'delimiter': self.csv_delimiter,
+            'quotechar': self.csv_quotechar,
+            'header': self.header_row,
+            'encoding': self.encoding,
+        }
+
+    def serialize(self, data):
+        """Serializes outgoing data, a dict or a list of dicts.
+        CSV is returned as a generator of encoded chunks of rows."""
+        self.ensure_one()
+        if self.engine == 'json':
+            return self._render_json(data)
+        elif self.engine == 'lxml_etree':
+            if isinstance(data, dict):
+                data = [data]
+            return self._render_lxml_etree(data)
+        elif self.engine == 'csv':
+            if isinstance(data, dict):
+                data = [data]
+            return self._render_csv(data)
+        return False
+
     def render(self, data, metadata={}, key=False):
         self.ensure_one()
         if key:
@@ -117,6 +199,8 @@ class ExternalDataSerializer(models.Model):
 
         if self.engine == 'json':
             return self._render_json(data)
+        elif self.engine == 'csv':
+            return self._render_csv((chunk if key else data) or [])
         elif self.engine == 'lxml_etree':
             return self._render_lxml_etree(chunk)
         elif self.engine == 'qweb':
@@ -133,6 +217,15 @@ class ExternalDataSerializer(models.Model):
     def render_json(self, data, indent=None):
         return json.dumps(data, indent=indent)
 
+    def _render_csv(self, items):
+        """Returns a generator of encoded CSV chunks, items are consumed
+        lazily, so they can be rendered in constant memory."""
+        self.ensure_one()
+        return csv_tools.render_chunks(
+            items, self._get_format_options(),
+            chunk_size=self.render_chunk_size or 1000,
+        )
+
     def _render_lxml_etree(self, items):
         self.ensure_one()
         if not isinstance(items, list):
@@ -290,6 +383,11 @@ class ExternalDataParserLine(models.Model):
             ('children', "children"),
             ('prev', "previous"),
             ('next', "next"),
+            ('jmespath', "JMESPath"),
+            ('jmespath_items', "JMESPath (multi)"),
+            ('csv_rows', "CSV rows"),
+            ('sheet_rows', "Worksheet rows"),
+            ('column', "column"),
             ('custom', "custom"),
         ],
         required=True,
@@ -321,282 +419,127 @@ class ExternalDataParserLine(models.Model):
 
     def objects(self, raw_data):
         "Returns a dict of object data generators"
-        if not self:
-            raise UserError("No parser directives defined")
+        context, plan, jmespath_expr = self._prepare_parse(raw_data)
         objects = {}
-
-        # assuming that all rules use the same engine
-        # TODO: prepare only if one engine found
-        data_prep = self.prepare(raw_data, self[0].engine)
-        foreign_type_ids = self.mapped('foreign_type_id').ids
-        for foreign_type_id in foreign_type_ids:
-            # getting toplevel rules for foreign type
-            rules = self.filtered(
-                lambda r:
-                r.active and
-                not r.parent_id and
-                r.foreign_type_id.id == foreign_type_id
+        for foreign_type_id, directives in plan.items():
+            objects[foreign_type_id] = parser.object_data_generator(
+                context, directives, foreign_type_id, context.root, vals={},
+                jmespath_expr=jmespath_expr,
             )
-            if not rules:
-                continue  # TODO: log, exception
+        return objects
 
-            # gettimg jmespath expression generator from serializer
-            expressions = self.serializer_id.jmespath_line_ids
-            jmespath_expr = expressions.get_jmespath_generators()
+    def tagged_objects(self, raw_data, foreign_type_ids=None,
+                       single_pass=False):
+        """Returns a generator of (foreign type ID, object data) pairs.
+        In single pass mode all foreign types are extracted by a single
+        traversal of the payload, otherwise one after the other."""
+        if not single_pass:
+            type_ids = set(self.filtered(
+                lambda r: r.active and not r.parent_id).foreign_type_id.ids)
+            if foreign_type_ids is not None:
+                type_ids &= set(foreign_type_ids)
+            if len(type_ids) > 1:
+                # each foreign type is parsed from the start of the payload
+                raw_data = payload.spool(raw_data)
+        context, plan, jmespath_expr = self._prepare_parse(raw_data)
+        if foreign_type_ids is not None:
+            plan = {
+                foreign_type_id: plan[foreign_type_id]
+                for foreign_type_id in foreign_type_ids
+                if foreign_type_id in plan
+            }
+        if single_pass:
+            return parser.merged_object_data(context, plan, jmespath_expr)
+        return (
+            (foreign_type_id, vals)
+            for foreign_type_id, directives in plan.items()
+            for vals in parser.object_data_generator(
+                context, directives, foreign_type_id, context.root,
+                vals={}, jmespath_expr=jmespath_expr,
+            )
+        )
 
-            # setting up generator
-            objects[foreign_type_id] = self.object_data_generator(
-                rules, data_prep, vals={}, jmespath_expr=jmespath_expr)
-        return objects
+    def _prepare_parse(self, raw_data):
+        """Returns the document context, the compiled plan and the JMESPath
+        expressions of a parse. Parsing doesn't touch the ORM from here."""
+        if not self:
+            raise UserError("No parser directives defined")
 
-    @api.model
-    def object_data_generator(self, rules, data, vals={}, jmespath_expr=[]):
-        foreign_type_id = rules.foreign_type_id.id
-        vals, generator, gen_rule_id = rules.get_object_data(
-            foreign_type_id, data, vals=vals,
+        # assuming that all rules use the same engine
+        # TODO: prepare only if one engine found
+        context = parser.DocumentContext(
+            self[0].engine, raw_data, streaming=self[0].is_streaming(),
+            options=self.serializer_id[:1]._get_format_options(),
         )
-        if generator is not None and gen_rule_id:
-            child_rules = self.search([
-                ('parent_id', '=', gen_rule_id),
-                ('active', '=', True),
-            ])
-            for child_data in generator:
-                gen = self.object_data_generator(
-                    child_rules, child_data, vals=vals,
-                    jmespath_expr=jmespath_expr,
-                )
-                for child_vals in gen:
-                    yield child_vals
-        else:
-            # rearrange by starting with an empty new dict
-            vals_parsed = {}
-            for expr in jmespath_expr:
-                parsed = expr(vals)
-                if parsed:
-                    vals_parsed.update(parsed)
-            if vals_parsed:
-                yield vals_parsed
-            else:
-                yield vals
-
-    def get_object_data(self, foreign_type_id, data,
-                        vals={}, generator=None, gen_rule_id=False):
-
-        for rule in self:
-            if rule.foreign_type_id.id != foreign_type_id:
-                continue
 
-            new_data = rule.execute(data)
-            if new_data is None:
-                msg = f"Parse rule (ID {rule.id}) execution returned no data"
-                _logger.debug(msg)
-                continue
+        # gettimg jmespath expression generator from serializer
+        expressions = self.serializer_id.jmespath_line_ids
+        jmespath_expr = expressions.get_jmespath_generators()
+        return context, self._compile_plan(), jmespath_expr
+
+    def _compile_plan(self):
+        """Compiles the active toplevel rules and their descendants.
+        Returns a dict of compiled directive tuples by foreign type ID."""
+        child_index = self._get_child_index()
+        plan = {}
+        for line in self.filtered(lambda r: r.active and not r.parent_id):
+            plan.setdefault(line.foreign_type_id.id, []).append(
+                line._compile_directive(child_index))
+        return {
+            foreign_type_id: tuple(directives)
+            for foreign_type_id, directives in plan.items()
+        }
 
-            if rule.is_generator():
-                if generator is not None:
-                    _logger.warning(
-                        "Multiple generator found for an object type "
-                        "at the same level. Returning the last one only."
-                    )
-                generator = new_data
-                gen_rule_id = rule.id
-            elif rule.child_ids:
-                child_rules = rule.child_ids
-                if rule.foreign_field_id and len(child_rules) > 1:
-                    _logger.warning(
-                        f"Field rule ID {rule.id} has multiple children!"
-                        "Processing the first one only."
-                    )
-                    child_rules = child_rules[0]
-                vals, generator, gen_rule_id = rule.child_ids.get_object_data(
-                    foreign_type_id, new_data, vals,
-                )
-            elif rule.foreign_field_id and rule.extract_method:
-                field_id = rule.foreign_field_id.name
-                vals[field_id] = new_data
-        return vals, generator, gen_rule_id
+    def _get_child_index(self):
+        """Returns the active child rules of the serializers by parent ID,
+        read with a single query."""
+        child_index = {}
+        for line in self.search([
+            ('serializer_id', 'in', self.serializer_id.ids),
+            ('parent_id', '!=', False),
+        ]):
+            child_index.setdefault(line.parent_id.id, []).append(line)
+        return child_index
+
+    def _compile_directive(self, child_index):
+        self.ensure_one()
+        child_lines = child_index.get(self.id, [])
+        if self.foreign_field_id and len(child_lines) > 1:
+            _logger.warning(
+                f"Field rule ID {self.id} has multiple children!")
+        return parser.Directive(
+            self.id,
+            self.engine,
+            self.foreign_type_id.id,
+            self.path_type,
+            self.path,
+            field_name=self.foreign_field_id.name or None,
+            extract_method=self.extract_method or None,
+            extract_param=self.extract_param or None,
+            streaming=self.is_streaming(),
+            children=[
+                child._compile_directive(child_index)
+                for child in child_lines
+            ],
+        )
 
     def is_generator(self):
         self.ensure_one()
         # TODO: can be different with different engines
-        if self.path_type in ['elementpath', 'findall', 'css_findall']:
-            return True
-        return False
+        return self.path_type in parser.GENERATOR_PATH_TYPES
 
-    def execute(self, data):
-        self.ensure_one()
-        if self.engine == 'lxml_etree':
-            data_prep = self._prepare_lxml_etree(data)
-            return self._execute_lxml_etree(data_prep)
-        if self.engine == 'bs':
-            data_prep = self._prepare_bs(data)
-            return self._execute_bs(data_prep)
-        else:
-            raise ValidationError("Engine is not supported yet")
-
-    def _execute_lxml_etree(self, data):
-        if data is None:
-            return None
+    def is_streaming(self):
         self.ensure_one()
-        # ignore namespace
-        # TODO: add option to it
-        path = "{*}" + self.path
-        if self.path_type == 'xpath':
-            chunk = data.xpath(path)
-        elif self.path_type == 'elementpath':
-            chunk = data.iterfind(path)
-        elif self.path_type == 'find':
-            chunk = data.find(path)
-        elif self.path_type == 'findall':
-            chunk = data.iter(path)
-        else:
-            return None
-
-        if chunk is None:
-            return None
-
-        if self.extract_method == 'attr' and self.extract_param:
-            return chunk.get(self.extract_param)
-
-        if self.extract_param:
-            chunk = chunk.find(self.extract_param)
-
-        if self.extract_method == 'text':
-            return chunk.text
-        elif self.extract_method == 'tag':
-            return chunk.tag
-        elif self.extract_method == 'tostring':
-            return etree.tostring(chunk)
-        else:
-            return chunk
+        return (
+            self.serializer_id.streaming and
+            self.engine in ['lxml_etree', 'json']
+        )
 
-    def _execute_bs(self, data):
-        if data is None:
-            return None
+    def execute(self, data):
         self.ensure_one()
-
-        name = False
-
-        attrs = dict(parse_qsl(self.path))
-        if not attrs:
-            name = self.path
-            attrs = {}
-
-        attrs_not = {}
-        for key in attrs.copy().keys():
-            if key[0] == '-':
-                attrs_not[key[1:]] = attrs.pop(key)
-
-        recursive = self.path_type == 'children'
-        index = start = end = None
-        if self.extract_method == 'index':
-            index_str = self.extract_param
-            index_split = index_str.split(':')
-            if len(index_split) == 2:
-                start = bs.get_index(index_split[0])
-                end = bs.get_index(index_split[1])
-            index = bs.get_index(index_str)
-
-        if self.path_type == 'find':
-            if index:
-                try:
-                    chunk = data.find_all(name=name, attrs=attrs)[index]
-                except IndexError:
-                    return None
-            else:
-                chunk = data.find(name=name, attrs=attrs)
-        elif self.path_type in ['next', 'prev']:
-            direction = self.path_type
-            gen = bs.findall(data, name, attrs, attrs_not,
-                             direction=direction)
-            try:
-                chunk = next(gen)
-            except StopIteration:
-                return None
-        elif self.path_type in ['children', 'findall']:
-            chunk = bs.findall(data, name, attrs, attrs_not,
-                               recursive=recursive, start=start, end=end)
-        elif self.path_type == 'css_find':
-            if index:
-                chunk = data.select(self.path)[index]
-            else:
-                chunk = data.select_one(self.path)
-        elif self.path_type == 'css_findall':
-            if start or end:
-                chunk = data.select(self.path)[start:end]
-            else:
-                chunk = data.select(self.path)
-            if not chunk:
-                return None
-            chunk = (e for e in chunk)
-        else:
-            return None
-
-        if attrs_not and isinstance(chunk, bs_element.Tag):
-            if not bs.compute_conditions(chunk, attrs_not=attrs_not):
-                return None
-        if chunk is None:
-            return None
-
-        if self.extract_method == 'attr' and self.extract_param:
-            return chunk.get(self.extract_param)
-
-        if self.extract_param:
-            chunk = chunk.find(self.extract_param)
-
-        if self.extract_method == 'text':
-            return chunk.string.strip()
-        elif self.extract_method == 'tag':
-            return chunk.name
-        elif self.extract_method == 'tostring':
-            return str(chunk)
-        elif self.extract_method == 'list':
-            if isinstance(chunk, (int, str)):
-                return [chunk]
-            elif isinstance(chunk, list):
-                return chunk
-            else:
-                return None
-        else:
-            return chunk
+        directive = self._compile_directive(self._get_child_index())
+        return parser.execute(directive, data)
 
     @api.model
     def prepare(self, data, engine):
-        if engine == 'lxml_etree':
-            return self._prepare_lxml_etree(data)
-        if engine == 'bs':
-            return self._prepare_bs(data)
-        else:
-            raise ValidationError("Engine is not supported yet")
-
-    @api.model
-    def _prepare_lxml_etree(self, data):
-        if isinstance(data, etree._Element):
-            return data
-        elif isinstance(data, BufferedReader):
-            data.seek(0)
-            data = data.read()
-
-        if isinstance(data, (str, bytes)):
-            try:
-                return etree.fromstring(data)
-            except Exception as e:
-                _logger.error(e)
-                return None
-        return None
-
-    @api.model
-    def _prepare_bs(self, data):
-        if isinstance(data, (BeautifulSoup, bs_element.Tag)):
-            return data
-        elif isinstance(data, BufferedReader):
-            data.seek(0)
-            data = data.read()
-
-        if isinstance(data, (str, bytes)):
-            try:
-                return BeautifulSoup(data, features="lxml")
-            except Exception as e:
-                _logger.error(e)
-                return None
-        return None
+        return parser.prepare(data, engine)
@@ -3,7 +3,6 @@
 import logging
 
 from odoo import api, fields, models
-from odoo.fields import Command
 from odoo.addons.http_routing.models.ir_http import slugify_one
 from odoo.exceptions import MissingError
 
@@ -98,7 +97,7 @@ class ExternalDataSource(models.Model):
             raise MissingError("No list strategy defined")
 
     def batch_pull(self, strategy_id=False, sync=False, prune=False,
-                   batch_size=False):
+                   batch_size=False, force=False):
         res_ids = self.resource_ids.filtered(
             lambda p: not p.skip and (
                 not p.last_pull or
@@ -118,7 +117,7 @@ class ExternalDataSource(models.Model):
 
         if strategy:
             strategy.batch_pull(res_ids, sync=sync, prune=prune,
-                                batch_size=batch_size)
+                                batch_size=batch_size, force=force)
 
 
 class ExternalDataResource(models.Model):
@@ -126,7 +125,7 @@ class ExternalDataResource(models.Model):
     _description = "External Data Resource"
 
     name = fields.Char(required=True)
-    url = fields.Char(required=True)
+    url = fields.Char(required=True, index=True)
     priority = fields.Float("Priority")
     skip = fields.Boolean()
     notes = fields.Text()
@@ -134,11 +133,21 @@ class ExternalDataResource(models.Model):
     last_pull = fields.Datetime("Last pull")
     last_push = fields.Datetime("Last push")
     valid_until = fields.Datetime("Valid until")
+    http_etag = fields.Char("ETag", copy=False)
+    http_last_modified = fields.Char("Last-Modified", copy=False)
+    payload_hash = fields.Char(
+        "Payload hash",
+        help="Hash of the payload of the last successful pull. "
+        "Unchanged payloads are skipped unless the pull is forced.",
+        copy=False,
+    )
+    pull_stats = fields.Char("Last pull statistics", copy=False)
     data_source_id = fields.Many2one(
         'external.data.source',
         ondelete='cascade',
         string="Data source",
         required=True,
+        index=True,
     )
     foreign_type_ids = fields.Many2many(
         comodel_name='external.data.type',
@@ -160,7 +169,7 @@ class ExternalDataResource(models.Model):
             record.skip = not record.skip
 
     # move all operation logic to strategies
-    def pull(self, strategy_id=False, sync=False, prune=False):
+    def pull(self, strategy_id=False, sync=False, prune=False, force=False):
         self.ensure_one()
         strategy = self.env['external.data.strategy']
         if strategy_id:
@@ -181,9 +190,11 @@ class ExternalDataResource(models.Model):
                 resource_ids=self.ids,
             )
         if strategy:
-            strategy.pull_resource(self.id, sync=sync, prune=prune)
+            strategy.pull_resource(
+                self.id, sync=sync, prune=prune, force=force)
 
-    def batch_pull(self, strategy_id=False, sync=False, prune=False):
+    def batch_pull(self, strategy_id=False, sync=False, prune=False,
+                   force=False):
         strategy = self.env['external.data.strategy']
         if strategy_id:
             strategy = strategy.browse(strategy_id)
@@ -193,19 +204,50 @@ class ExternalDataResource(models.Model):
                 resource_ids=self.ids,
             )
         if strategy:
-            strategy.batch_pull(self.ids, do_all=True, sync=sync, prune=prune)
+            strategy.batch_pull(
+                self.ids, do_all=True, sync=sync, prune=prune, force=force)
 
-    def prune_objects(self, foreign_objects):
+    def prune_objects(self, foreign_objects, foreign_type_ids=None,
+                      purge_orphans=False):
+        """Unlinks external objects of the resource missing from
+        'foreign_objects', a set of (foreign_type_id, foreign_id) pairs,
+        optionally only the ones of the given foreign types.
+        Returns the IDs of the unlinked objects."""
         self.ensure_one()
-        found_object_ids = []
-        for foreign_type_id, foreign_id in self.object_ids:
-            found_object_ids += self.object_ids.filtered(lambda o: all([
-                o.foreign_type_id == foreign_type_id,
-                o.foreign_id == foreign_id,
-            ])).ids
-        unrelated_object_ids = set(self.object_ids.ids) - set(found_object_ids)
-        self.object_ids = [Command.unlink(i) for i in unrelated_object_ids]
-        # TODO: delete orphan objects
+        ext_objects = self.env['external.data.object']
+        field = self._fields['object_ids']
+        self.flush(['object_ids'])
+        ext_objects.flush(['foreign_type_id', 'foreign_id'])
+        seen_type_ids, seen_foreign_ids = [], []
+        for foreign_type_id, foreign_id in foreign_objects:
+            seen_type_ids.append(foreign_type_id)
+            seen_foreign_ids.append(foreign_id)
+        query = f"""
+            DELETE FROM {field.relation} rel
+            USING external_data_object o
+            WHERE rel.{field.column1} = %s
+            AND o.id = rel.{field.column2}
+            AND NOT EXISTS (
+                SELECT 1 FROM unnest(%s::int[], %s::varchar[])
+                    AS seen(foreign_type_id, foreign_id)
+                WHERE seen.foreign_type_id = o.foreign_type_id
+                AND seen.foreign_id = o.foreign_id
+            )
+        """
+        params = [self.id, seen_type_ids, seen_foreign_ids]
+        if foreign_type_ids is not None:
+            query += " AND o.foreign_type_id = ANY(%s)"
+            params.append(list(foreign_type_ids))
+        self.env.cr.execute(query + f" RETURNING rel.{field.column2}", params)
+        pruned_ids = [row[0] for row in self.env.cr.fetchall()]
+        if pruned_ids:
+            _logger.info(f"Unlinked {len(pruned_ids)} objects "
+                         f"from resource {self.name}")
+            self.invalidate_cache(['object_ids'], self.ids)
+            ext_objects.invalidate_cache(['resource_ids'], pruned_ids)
+            if purge_orphans:
+                ext_objects.purge_orphans(pruned_ids)
+        return pruned_ids
 
     def button_open(self):
         self.ensure_one()
@@ -1,16 +1,24 @@
 # coding: utf-8
 
 from datetime import datetime
+from itertools import count, groupby, islice
+from operator import itemgetter
 
 from odoo import api, fields, models
 from odoo.fields import Command
 from odoo.osv import expression
 from odoo.addons.http_routing.models.ir_http import slugify_one
 from odoo.exceptions import MissingError, UserError
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+from odoo.tools.lru import LRU
+
+from ..tools import fetcher, http, payload
 
 import logging
 _logger = logging.getLogger(__name__)
 
+QUEUE_MAX_RETRIES = 3
+
 
 class ExternalDataStrategy(models.Model):
     _name = 'external.data.strategy'
@@ -63,6 +71,74 @@ class ExternalDataStrategy(models.Model):
         domain="[('data_source_id', '=', data_source_id)]",
     )
     batch_size = fields.Integer("Batch size", default=10)
+    fetch_concurrency = fields.Integer(
+        "Fetch concurrency",
+        help="Number of threads fetching resources in advance "
+        "during batch pulls. Resources are fetched one by one if below 2, "
+        "or if the transporter streams payloads.",
+        default=1,
+    )
+    prefetch_size = fields.Integer(
+        "Prefetch size",
+        help="Maximum number of resources fetched in advance.",
+        default=4,
+    )
+    chunk_size = fields.Integer(
+        "Chunk size",
+        help="Number of parsed objects processed together "
+        "when looking up existing records.",
+        default=500,
+    )
+    purge_orphans = fields.Boolean(
+        "Purge orphans",
+        help="When pruning, delete external objects no longer referenced "
+        "by any resource, and object links left without objects. "
+        "Linked records are kept.",
+    )
+    create_chunk_size = fields.Integer(
+        "Create chunk size",
+        help="Number of records created at once by deferred create.",
+        default=1000,
+    )
+    deferred_update = fields.Boolean(
+        "Deferred update",
+        help="Buffer writes of existing records, and flush them at the end "
+        "of each chunk, records with identical values written at once. "
+        "Post-processing rules see record values from before the chunk.",
+    )
+    skip_unchanged = fields.Boolean(
+        "Skip unchanged objects",
+        help="Skip writing records whose mapped values are the same "
+        "as at the previous pull.",
+    )
+    skip_unchanged_post = fields.Boolean(
+        "Skip post-processing of unchanged objects",
+        help="Skip post-processing rules too, if the pre-processed values "
+        "of an object are unchanged.",
+    )
+    binary_fetch_workers = fields.Integer(
+        "Binary fetch workers",
+        help="Number of threads fetching binaries for batched "
+        "'fetch binary' rules.",
+        default=8,
+    )
+    binary_fetch_per_host = fields.Integer(
+        "Binary fetches per host",
+        help="Maximum number of concurrent binary fetches per host.",
+        default=2,
+    )
+    queued = fields.Boolean(
+        "Queued",
+        help="Pulled by the 'External Data: queued pulls' scheduled action. "
+        "Duplicate the action or run queue_pull() in several processes "
+        "to pull in parallel.",
+    )
+    queue_claim_size = fields.Integer(
+        "Claim size",
+        help="Number of resources claimed and committed together "
+        "by queued pulls.",
+        default=10,
+    )
     exposed = fields.Boolean("Exposed to REST")
 
     @api.depends('name')
@@ -118,35 +194,171 @@ class ExternalDataStrategy(models.Model):
             return strategy
         raise UserError(err_msg)
 
-    def list(self):
+    def list(self, force=False):
         self.ensure_one()
         if self.operation != 'list':
             raise UserError(f"Wrong operation type for pull: {self.operation}")
         if len(self.resource_ids) == 1:
-            self.pull_resource(self.resource_ids.id, sync=True, prune=True)
+            self.pull_resource(
+                self.resource_ids.id, sync=True, prune=True, force=force)
         elif len(self.resource_ids) > 1:
-            self.batch_pull(self.resource_ids.ids, sync=True, prune=True)
+            self.batch_pull(
+                self.resource_ids.ids, sync=True, prune=True, force=force)
         else:
             raise MissingError("No resources defined for this lister")
 
     def batch_pull(self, resource_ids, sync=False, prune=False,
-                   do_all=False, batch_size=False):
-
+                   do_all=False, batch_size=False, force=False,
+                   queued=False):
+        """Pulls resources. Queued pulls return the IDs of the resources
+        to retry in a new transaction because of concurrent updates."""
         if not batch_size:
             batch_size = self.batch_size
-        for i, res_id in enumerate(resource_ids):
+        if not do_all:
+            resource_ids = resource_ids[:batch_size + 1]
+        retry_ids = []
+        prefetched = self._prefetch(resource_ids, sync=sync, force=force)
+        for res_id, fetched in prefetched:
             try:
-                self.pull_resource(res_id, sync=sync, prune=prune)
+                if queued:
+                    with self.env.cr.savepoint():
+                        self.pull_resource(
+                            res_id, sync=sync, prune=prune, force=force,
+                            prefetched=fetched, queued=True,
+                        )
+                else:
+                    self.pull_resource(
+                        res_id, sync=sync, prune=prune, force=force,
+                        prefetched=fetched,
+                    )
             except Exception as e:
+                if queued and getattr(e, 'pgcode', None) in \
+                        PG_CONCURRENCY_ERRORS_TO_RETRY:
+                    _logger.info(
+                        f"Concurrent update, resource ID {res_id} "
+                        "will be pulled again in a new transaction")
+                    retry_ids.append(res_id)
+                    continue
                 _logger.error(e)
                 resource = self.env['external.data.resource'].browse(res_id)
                 if resource.exists():
                     resource.notes = ("Pull error:\n" + str(e))
                     resource.skip = True
-            if i == batch_size and not do_all:
+        return retry_ids
+
+    def queue_pull(self, sync=True, prune=False, force=False, limit=None):
+        """Pulls due resources in chunks claimed with row locks, committing
+        each chunk, so several workers can pull the same data source
+        in parallel. Returns the number of pulled resources."""
+        self.ensure_one()
+        if self.operation != 'pull':
+            raise UserError(f"Wrong operation type for pull: {self.operation}")
+        claim_size = max(self.queue_claim_size, 1)
+        done_ids = []
+        retries = {}
+        while limit is None or len(done_ids) < limit:
+            if limit is not None:
+                claim_size = min(claim_size, limit - len(done_ids))
+            res_ids = self._claim_resources(
+                claim_size, exclude_ids=done_ids, force=force)
+            if not res_ids:
                 break
+            retry_ids = self.batch_pull(
+                res_ids, sync=sync, prune=prune, do_all=True, force=force,
+                queued=True)
+            for res_id in retry_ids:
+                retries[res_id] = retries.get(res_id, 0) + 1
+            done_ids += [
+                res_id for res_id in res_ids
+                if res_id not in retry_ids
+                or retries[res_id] > QUEUE_MAX_RETRIES
+            ]
+            self.flush()
+            self.env.cr.commit()
+            _logger.info(
+                f"Strategy {self.name}: pulled {len(done_ids)} resources")
+        return len(done_ids)
+
+    def _claim_resources(self, limit, exclude_ids=(), force=False):
+        """Locks and returns IDs of resources due for pull,
+        skipping the ones locked by other transactions."""
+        self.ensure_one()
+        self.env['external.data.resource'].flush(
+            ['data_source_id', 'skip', 'last_mod', 'last_pull'])
+        query = (
+            "SELECT id FROM external_data_resource "
+            "WHERE data_source_id = %s AND skip IS NOT TRUE "
+            "AND NOT (id = ANY(%s))"
+        )
+        params = [self.data_source_id.id, list(exclude_ids)]
+        if not force:
+            query += " AND (last_pull IS NULL OR last_mod > last_pull)"
+        if self.resource_ids:
+            query += " AND id = ANY(%s)"
+            params.append(self.resource_ids.ids)
+        query += " ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED"
+        params.append(limit)
+        self.env.cr.execute(query, params)
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.model
+    def _cron_queue_pull(self):
+        for strategy in self.search([
+            ('queued', '=', True),
+            ('operation', '=', 'pull'),
+        ]):
+            strategy.queue_pull(sync=True)
+
+    def _prefetch(self, resource_ids, sync=False, force=False):
+        """Yields (resource ID, prefetched) pairs for pull_resource().
+        If fetch concurrency is set, payloads are fetched in advance in
+        threads, 'prefetched' is a (future, validators) pair, else None.
+        Streamed payloads are not prefetched: workers would only get the
+        headers, holding a connection each until the body is parsed."""
+        self.ensure_one()
+        if self.fetch_concurrency < 2 or not self.transporter_id or \
+                self.transporter_id.streaming:
+            for res_id in resource_ids:
+                yield res_id, None
+            return
+
+        resources = self.env['external.data.resource']
+        transporter = self.transporter_id
+
+        def requests():
+            for res_id in resource_ids:
+                validators = self._get_validators(
+                    resources.browse(res_id), sync=sync, force=force)
+                request = transporter.prepare_fetch(
+                    res_id, validators=validators)
+                yield res_id, request, validators
+
+        for res_id, future, validators in fetcher.prefetch(
+                requests(), workers=self.fetch_concurrency,
+                ahead=max(self.prefetch_size, 1)):
+            yield res_id, (future, validators)
+
+    @api.model
+    def _get_validators(self, resource, sync=False, debug=False,
+                        force=False):
+        """Returns the cache validators of a resource for a conditional
+        fetch, None if the pull doesn't skip unchanged resources."""
+        if not sync or debug:
+            return None
+        if force or not resource.exists():
+            return {}
+        return {
+            'http_etag': resource.http_etag,
+            'http_last_modified': resource.http_last_modified,
+        }
 
-    def pull_resource(self, resource_id, sync=False, prune=False, debug=False):
+    def pull_resource(self, resource_id, sync=False, prune=False, debug=False,
+                      force=False, prefetched=None, queued=False):
+        """Pulls a resource. Synced pulls skip resources unchanged since
+        their last successful pull, unless 'force' is set.
+        'prefetched' is a (future, validators) pair from _prefetch().
+        'queued' pulls lock external objects on create, as other workers
+        may pull the same objects concurrently."""
         self.ensure_one()
         if self.operation not in ['list', 'pull']:
             raise UserError(f"Wrong operation type for pull: {self.operation}")
@@ -156,106 +368,247 @@ class ExternalDataStrategy(models.Model):
         resource_name = resource.name
         _logger.info(f"Pulling resource {resource_name}")
 
-        # fetch
-        raw_data = self.transporter_id.fetch(resource_id)
+        # fetch, conditionally if the pull writes
+        check_unchanged = sync and not debug
+        if prefetched:
+            future, validators = prefetched
+            raw_data = future.result()
+        else:
+            validators = self._get_validators(
+                resource, sync=sync, debug=debug, force=force)
+            raw_data = self.transporter_id.fetch(
+                resource_id, validators=validators)
+        if raw_data is http.NOT_MODIFIED:
+            _logger.info(f"Resource {resource_name} not modified, skipping")
+            resource.last_pull = datetime.now()
+            return
+        processed_data = binary_fetcher = None
+        try:
+            payload_hash = False
+            if check_unchanged:
+                payload_hash, raw_data = payload.fingerprint(raw_data)
+                if (not force and payload_hash and
+                        payload_hash == resource.payload_hash):
+                    _logger.info(
+                        f"Resource {resource_name} unchanged, skipping")
+                    # validators may change with the same payload
+                    resource.write(dict(
+                        validators or {}, payload_hash=payload_hash,
+                        last_pull=datetime.now()))
+                    return
 
-        # extract & parse
-        data_source = self.data_source_id
-        parser = self.serializer_id
-        processed_data = parser.extraxt(raw_data)
+            # extract & parse
+            data_source = self.data_source_id
+            parser = self.serializer_id
+            processed_data = parser.extraxt(raw_data)
+            binary_fetcher = fetcher.BinaryFetcher(
+                self.transporter_id.get_session(),
+                workers=self.binary_fetch_workers,
+                per_host=self.binary_fetch_per_host,
+                cache=self.transporter_id.get_binary_cache(),
+            )
 
-        metadata = {  # TODO: could it be the context?
-            'operation': self.operation,
-            'deferred_create': self.deferred_create,
-            'data_source_id': data_source.id,
-            'resource_id': resource_id,
-            'resource_name': resource_name,
-            'strategy_id': self.id,
-            'strategy_name': self.name,
-            'parser_id': parser.id,
-            'sync': sync,
-            'prune': prune,
-            'debug': debug,
-            'keep': {},
-        }
-        if self.operation == 'list':
-            metadata['resources'] = self.data_source_id.resource_ids
-        field_mappings_all = self.field_mapping_ids
-        foreign_types = field_mappings_all.mapped('foreign_type_id')
-        object_data_generators = parser.parse(processed_data)
-        foreign_objects = []
-        debug_data, debug_metadata = {}, {}
-        deferred_create_data = {}
-        for foreign_type in foreign_types:
-            if not foreign_type.field_ids:
-                raise MissingError(
-                    f"No fields defined for foreign type ID {foreign_type.id}")
-            data_generator = object_data_generators.get(foreign_type.id)
-            if not data_generator:
-                continue
+            metadata = {  # TODO: could it be the context?
+                'operation': self.operation,
+                'deferred_create': self.deferred_create,
+                'data_source_id': data_source.id,
+                'resource_id': resource_id,
+                'resource_name': resource_name,
+                'strategy_id': self.id,
+                'strategy_name': self.name,
+                'transporter_id': self.transporter_id.id,
+                'parser_id': parser.id,
+                'sync': sync,
+                'prune': prune,
+                'debug': debug,
+                'keep': {},
+                'lookup_cache': {},
+                'queued': queued,
+                'skip_unchanged': self.skip_unchanged,
+                'skip_unchanged_post': self.skip_unchanged_post,
+                'stats': {'created': 0, 'written': 0, 'skipped': 0},
+                'binary_fetcher': binary_fetcher,
+                'image_cache': LRU(32),
+                'pending_binaries': [],
+                'update_buffer': {} if self.deferred_update else None,
+            }
+            if self.operation == 'list':
+                resources = self.data_source_id.resource_ids
+                metadata.update({
+                    'resources': resources,
+                    'resource_index': {res.url: res.id for res in resources},
+                })
+            field_mappings_all = self.field_mapping_ids
+            foreign_types = field_mappings_all.mapped('foreign_type_id')
+            for foreign_type in foreign_types:
+                if not foreign_type.field_ids:
+                    raise MissingError(
+                        "No fields defined for foreign type ID "
+                        f"{foreign_type.id}")
+            object_data = parser.parse_stream(
+                processed_data, foreign_type_ids=foreign_types.ids)
+            single_pass = parser.single_pass
+            foreign_objects = set()
+            chunk_size = self.chunk_size or 1
+            metadata['similar_type_ids'] = {}
+            debug_data, debug_metadata = {}, {}
+            deferred_create_data = {}  # {foreign type ID: {model: data}}
+            type_states = {}
+            foreign_type_id = None
 
-            # executing db queries outside of the parsing loop when possible
-            field_mappings = field_mappings_all.filtered(
-                lambda m: m.foreign_type_id.id == foreign_type.id
+            # map & process in chunks of object data tagged by foreign type
+            while True:
+                chunk = [
+                    (type_id, data.copy() if data else data)
+                    for type_id, data in islice(object_data, chunk_size)
+                ]
+                if not chunk:
+                    break
+                for new_type_id, type_items in groupby(chunk, itemgetter(0)):
+                    if sync and not single_pass and foreign_type_id and \
+                            new_type_id != foreign_type_id:
+                        # previous type is done, create its deferred records
+                        self._flush_updates(metadata)
+                        self._write_pending_binaries(metadata)
+                        self._flush_deferred_create(
+                            deferred_create_data.pop(foreign_type_id, {}))
+                    foreign_type_id = new_type_id
+                    type_state = type_states.get(foreign_type_id)
+                    if type_state is None:
+                        type_state = type_states[foreign_type_id] = \
+                            self._get_type_state(
+                                foreign_types.browse(foreign_type_id),
+                                field_mappings_all, data_source,
+                            )
+                        if debug:
+                            type_name = type_state['metadata'][
+                                'foreign_type_name']
+                            debug_data[type_name] = []
+                            debug_metadata[type_name] = []
+                    metadata.update(type_state['metadata'], record=False)
+                    field_mappings = type_state['field_mappings']
+                    type_chunk = [
+                        (next(type_state['counter']), data)
+                        for _, data in type_items
+                    ]
+                    dc_data = deferred_create_data.setdefault(
+                        foreign_type_id, {})
+                    if sync and self.operation == 'pull':
+                        self._resolve_similar_links(
+                            type_chunk, field_mappings, metadata)
+                    for index, data in type_chunk:
+                        metadata['index'] = index
+                        if not data:
+                            continue
+                        if debug:
+                            type_name = metadata['foreign_type_name']
+                            debug_data[type_name].append(data.copy())
+                            debug_metadata[type_name].append(metadata.copy())
+                            continue
+                        for field_mapping in field_mappings:
+                            foreign_id = data.get(metadata['foreign_id_key'])
+                            if not foreign_id:
+                                msg = "Missing foreign ID from resource " \
+                                    f"{metadata.get('resource_name')}"
+                                _logger.error(msg)
+                                continue
+                            metadata['obj_link_variant_tag'] = \
+                                field_mapping.object_link_variant_tag
+                            # object foreign IDs are strings, parsed ones
+                            # may be numbers
+                            foreign_id = str(foreign_id)
+                            metadata['foreign_id'] = foreign_id
+                            if prune:
+                                foreign_objects.add(
+                                    (metadata['foreign_type_id'], foreign_id))
+                            if sync:
+                                self._pull_mapping(
+                                    data, metadata, dc_data, field_mapping,
+                                )
+                        if sync:
+                            resource.last_pull = datetime.now()
+                            resource.foreign_type_ids = [
+                                Command.link(metadata['foreign_type_id'])]
+                        if not ((index + 1) % 100):  # don't want to log #0
+                            _logger.info(f"Processing object #{index + 1}")
+                if sync:
+                    self._flush_updates(metadata)
+                    self._write_pending_binaries(metadata)
+            if sync:
+                for foreign_type_id in foreign_types.ids:
+                    self._flush_deferred_create(
+                        deferred_create_data.pop(foreign_type_id, {}))
+        finally:
+            if binary_fetcher is not None:
+                binary_fetcher.close()
+            # release streams, parsers are done with them
+            for stream in (processed_data, raw_data):
+                if hasattr(stream, 'close'):
+                    stream.close()
+
+        if prune:
+            resource.prune_objects(
+                foreign_objects, foreign_type_ids=foreign_types.ids,
+                purge_orphans=self.purge_orphans,
             )
-            external_objects = self.env['external.data.object'].search([
-                ('data_source_id', '=', data_source.id),
-                ('foreign_type_id', '=', foreign_type.id),
-            ])
-            metadata.update({
+        if check_unchanged:
+            resource.write(dict(validators, payload_hash=payload_hash))
+        if sync:
+            stats = metadata['stats']
+            resource.pull_stats = ", ".join(
+                f"{value} {key}" for key, value in stats.items())
+            _logger.info(
+                f"Pulled resource {resource_name}: {resource.pull_stats}")
+        if debug:
+            return debug_data, debug_metadata
+
+    def _get_type_state(self, foreign_type, field_mappings_all, data_source):
+        """Returns the metadata and field mappings of a foreign type,
+        executing db queries outside of the parsing loop when possible."""
+        external_objects = self.env['external.data.object']
+        return {
+            'metadata': {
                 'foreign_type_id': foreign_type.id,
                 'foreign_type_name': foreign_type.name,
                 'foreign_id_key': foreign_type.field_ids[0].name,
                 'external_objects': external_objects,
+                'external_object_index': external_objects.get_object_index(
+                    data_source.id, foreign_type.id),
                 'now': datetime.now(),
-                'record': False,
-            })
-            if debug:
-                debug_data[foreign_type.name] = []
-                debug_metadata[foreign_type.name] = []
+            },
+            'field_mappings': field_mappings_all.filtered(
+                lambda m: m.foreign_type_id.id == foreign_type.id
+            ),
+            'counter': count(),
+        }
 
-            # map & process
-            for index, data in enumerate(data_generator):
-                metadata['index'] = index
-                if not data:
-                    continue
-                if debug:
-                    type_name = metadata['foreign_type_name']
-                    debug_data[type_name].append(data.copy())
-                    debug_metadata[type_name].append(metadata.copy())
-                    continue
-                for field_mapping in field_mappings:
-                    foreign_id = data.get(metadata['foreign_id_key'])
-                    if not foreign_id:
-                        msg = "Missing foreign ID from resource {}".format(
-                            metadata.get('resource_name'))
-                        _logger.error(msg)
-                        continue
-                    metadata['obj_link_variant_tag'] = \
-                        field_mapping.object_link_variant_tag
-                    metadata['foreign_id'] = foreign_id
-                    if prune:
-                        foreign_objects.append(
-                            (metadata['foreign_type_id'], foreign_id))
-                    if sync:
-                        self._pull_mapping(
-                            data, metadata, deferred_create_data,
-                            field_mapping,
-                        )
-                if sync:
-                    resource.last_pull = datetime.now()
-                    resource.foreign_type_ids = [
-                        Command.link(metadata['foreign_type_id'])]
-                if not ((index + 1) % 100):  # don't want to log #0
-                    _logger.info(f"Processing object #{index + 1}")
-            if sync and deferred_create_data:
-                for model, dc_data in deferred_create_data.items():
-                    self._pull_deferred_create(model, **dc_data)
+    def _flush_deferred_create(self, dc_data):
+        for model, dc_data_model in dc_data.items():
+            self._pull_deferred_create(model, **dc_data_model)
 
-        if prune:
-            resource.prune_objects(foreign_objects)
-        if debug:
-            return debug_data, debug_metadata
+    @api.model
+    def _resolve_similar_links(self, chunk, field_mappings, metadata):
+        """Resolves links of similar objects for all foreign IDs
+        of a chunk at once, for each field mapping."""
+        foreign_id_key = metadata['foreign_id_key']
+        foreign_ids = {
+            str(data[foreign_id_key]) for _, data in chunk
+            if data and data.get(foreign_id_key)
+        }
+        ext_objects = self.env['external.data.object']
+        similar_links = metadata['similar_links'] = {}
+        for field_mapping in field_mappings:
+            model_id = field_mapping.model_id.id
+            variant_tag = field_mapping.object_link_variant_tag
+            similar_type_ids = ext_objects.get_similar_type_ids(
+                model_id, metadata['data_source_id'],
+                cache=metadata['similar_type_ids'],
+            )
+            similar_links[(model_id, variant_tag)] = \
+                ext_objects.resolve_similar_links(
+                    model_id, foreign_ids, similar_type_ids,
+                    variant_tag=variant_tag,
+                )
 
     @api.model
     def _append_deferred_create_data(self, vals, data, metadata, dc_data):
@@ -295,6 +648,9 @@ class ExternalDataStrategy(models.Model):
 
         # post processing
         postprocess_rules = metadata.get('postprocess_rules')
+        if metadata.get('vals_unchanged') and \
+                metadata.get('skip_unchanged_post'):
+            return True
         if record and postprocess_rules:
             metadata.update({
                 'pre_post': 'post',
@@ -308,10 +664,83 @@ class ExternalDataStrategy(models.Model):
                 metadata.pop('drop')
                 return True
             self._prune_vals(vals, **metadata)
+            if vals and metadata.get('skip_unchanged'):
+                ext_object = metadata['external_objects'].browse(
+                    metadata.get('external_object_id'))
+                hash_key = f"{field_mapping.id}:post"
+                vals_hash = payload.vals_digest(vals)
+                if ext_object.get_vals_hashes().get(hash_key) == vals_hash:
+                    return True
+                ext_object.set_vals_hashes(**{hash_key: vals_hash})
             if vals:
-                metadata['external_objects'].sanitize_values(vals, **metadata)
+                ext_object = metadata['external_objects'].browse(
+                    metadata.get('external_object_id'))
+                checksums = ext_object.get_binary_checksums(
+                    record, field_mapping.id)
+                metadata['external_objects'].sanitize_values(
+                    vals, binary_checksums=checksums, **metadata)
                 if not field_mapping.skip_write:
-                    metadata['record'].write(vals)
+                    pending = self._pop_pending_binaries(vals)
+                    update_buffer = metadata.get('update_buffer')
+                    if update_buffer is not None:
+                        ext_object._buffer_write(
+                            update_buffer, metadata['record'], vals)
+                    else:
+                        metadata['record'].write(vals)
+                    ext_object.set_binary_checksums(
+                        field_mapping.id, checksums)
+                    if pending:
+                        metadata['pending_binaries'].append((
+                            metadata['record'], pending, ext_object,
+                            field_mapping.id,
+                        ))
+
+    @api.model
+    def _flush_updates(self, metadata):
+        """Writes the buffered updates, records with identical values
+        at once."""
+        update_buffer = metadata.get('update_buffer')
+        if not update_buffer:
+            return
+        for model_model, record_vals in update_buffer.items():
+            writes = {}  # {vals digest: (vals, record IDs)}
+            for record_id, vals in record_vals.items():
+                vals_hash = payload.vals_digest(vals)
+                writes.setdefault(vals_hash, (vals, []))[1].append(record_id)
+            records = self.env[model_model]
+            for vals, record_ids in writes.values():
+                records.browse(record_ids).exists().write(vals)
+        update_buffer.clear()
+
+    @api.model
+    def _pop_pending_binaries(self, vals):
+        """Pops binaries being fetched from vals, to be written later."""
+        return {
+            key: vals.pop(key) for key, value in list(vals.items())
+            if isinstance(value, fetcher.PendingBinary)
+        }
+
+    @api.model
+    def _write_pending_binaries(self, metadata):
+        """Writes the binaries fetched for the records of a chunk."""
+        pending_binaries = metadata.get('pending_binaries')
+        ext_objects = self.env['external.data.object']
+        while pending_binaries:
+            record, vals, ext_object, field_mapping_id = \
+                pending_binaries.pop(0)
+            if not record.exists():
+                continue
+            checksums = ext_object.get_binary_checksums(
+                record, field_mapping_id)
+            ext_objects.resolve_pending_binaries(
+                vals, record._name, checksums=checksums,
+                processed=metadata.get('image_cache'),
+            )
+            if vals:
+                record.write(vals)
+                ext_object.set_binary_checksums(field_mapping_id, checksums)
+        if metadata.get('binary_fetcher'):
+            metadata['binary_fetcher'].clear()
 
     @api.model
     def _pull(self, field_mapping, data, metadata):
@@ -319,6 +748,7 @@ class ExternalDataStrategy(models.Model):
         resource_id = metadata.get('resource_id')
         if not (foreign_id and resource_id):
             return False
+        foreign_id = str(foreign_id)  # as indexed, numbers wouldn't match
 
         object_vals = {
             'data_source_id': metadata['data_source_id'],
@@ -328,17 +758,26 @@ class ExternalDataStrategy(models.Model):
             'priority': metadata['index'],
         }
         metadata['object_vals'] = object_vals.copy()  # for deferred create too
+        metadata['vals_unchanged'] = False
         # get record and external object
         variant_tag = metadata.get('obj_link_variant_tag', False)
-        record = ext_object = False
-        for o in metadata['external_objects']:
-            if o.foreign_id == foreign_id:
-                o.resource_ids = [Command.link(resource_id)]
-                ext_object = o
-                break
-        if not (ext_object or metadata['deferred_create']):
-            ext_object = metadata['external_objects'].create(object_vals)
-            metadata['external_objects'] += ext_object
+        record = False
+        inserted = True
+        ext_object = metadata['external_objects']
+        object_index = metadata['external_object_index']
+        object_key = (metadata['foreign_type_id'], foreign_id)
+        if object_key in object_index:
+            ext_object = ext_object.browse(object_index[object_key])
+            ext_object.resource_ids = [Command.link(resource_id)]
+            # own record, compared with the values hashes below
+            record = metadata['record'] = \
+                ext_object._record(metadata['model_id'], variant_tag)
+        elif metadata.get('queued') and not metadata['deferred_create']:
+            ext_object, inserted = ext_object.insert_or_fetch(object_vals)
+            object_index[object_key] = ext_object.id
+        elif not metadata['deferred_create']:
+            ext_object = ext_object.create(object_vals)
+            object_index[object_key] = ext_object.id
 
         # looking for record created by other data sources
         if ext_object.link_similar_objects(**metadata):
@@ -375,11 +814,41 @@ class ExternalDataStrategy(models.Model):
             else:
                 return False
 
-        # write record
+        if not (record or inserted):
+            # the object was inserted by a concurrent worker with its record
+            _logger.info(f"Object {foreign_id} is pulled by another worker")
+            # no post processing with what is left of the previous item
+            metadata.update(record=False, postprocess_rules=False)
+            return False
+
+        # write record, unless its values are the same as at the last pull
+        stats = metadata['stats']
+        pending = {}
         if vals and not field_mapping.skip_write:
-            ext_object.write_odoo_record(vals, metadata)
+            hash_key = str(field_mapping.id)
+            vals_hash = metadata.get('skip_unchanged') and \
+                payload.vals_digest(vals)
+            if record and vals_hash and \
+                    ext_object.get_vals_hashes().get(hash_key) == vals_hash:
+                metadata['vals_unchanged'] = True
+                stats['skipped'] += 1
+            else:
+                pending = self._pop_pending_binaries(vals)
+                ext_object.write_odoo_record(vals, metadata)
+                if record:
+                    stats['written'] += 1
             metadata['record'] = ext_object._record(
                 metadata['model_id'], variant_tag)
+            if not record and metadata['record']:
+                stats['created'] += 1
+            if pending and metadata['record']:
+                metadata['pending_binaries'].append((
+                    metadata['record'], pending, ext_object,
+                    field_mapping.id,
+                ))
+            if vals_hash and metadata['record'] and \
+                    not metadata['vals_unchanged']:
+                ext_object.set_vals_hashes(**{hash_key: vals_hash})
         metadata['postprocess_rules'] = field_mapping.rule_ids_post
         metadata['postprocess_rules'] += ext_object.rule_ids_post
         return vals
@@ -395,12 +864,10 @@ class ExternalDataStrategy(models.Model):
 
         # get resource
         resource = False
-        for res in metadata['resources']:
-            if res.url == foreign_id:
-                resource = metadata['record'] = res
-                break
-        if resource:
-            metadata['resources'] -= resource
+        res_id = metadata['resource_index'].pop(foreign_id, False)
+        if res_id:
+            resource = metadata['resources'].browse(res_id)
+            metadata['record'] = resource
             res_last_mod = resource.last_mod  # for later use
             if not res_last_mod:
                 return False
@@ -450,15 +917,13 @@ class ExternalDataStrategy(models.Model):
                               metadata):
         """At this point we are sure that we encountered a new external object,
         therefore there is no need to lookup existing object links.
+        Records, external objects and object links are created in bulk,
+        in chunks of 'create_chunk_size'.
         """
         self.ensure_one()
         for key in ['field_mapping_id', 'resource_id']:
             assert isinstance(metadata.get(key), int)
 
-        # creating records
-        _logger.info(f"Creating {len(vals)} records in model {model_model}")
-        records = self.env[model_model].create(vals)
-
         # getting field mapping and resource
         field_mapping = self.env['external.data.field.mapping'].browse(
             metadata['field_mapping_id']).exists()
@@ -468,43 +933,118 @@ class ExternalDataStrategy(models.Model):
             _logger.error("Deferred create is not possible, missing metadata")
             return False
 
-        # post processing
-        ext_objects = self.env['external.data.object']
-        post_rules = field_mapping.rule_ids_post
-        if post_rules:
-            metadata.update({'pre_post': 'post'})
-            for i, data_i in enumerate(data):
-                record = metadata['record'] = records[i]
-                vals = field_mapping.apply_mapping(data_i, metadata)
-                post_rules.apply_rules(vals, metadata)
-                ext_objects.sanitize_values(vals, model_model)
-                record.write(vals)
+        if self.operation != 'pull':
+            object_vals = []
+        elif metadata.get('queued'):
+            vals, data, object_vals = self._deferred_insert_objects(
+                vals, data, object_vals, metadata)
+        chunk_size = self.create_chunk_size or len(vals) or 1
+        for start in range(0, len(vals), chunk_size):
+            end = start + chunk_size
+            records = self._deferred_create_records(
+                model_model, vals[start:end], metadata)
+            self._deferred_post_process(
+                records, field_mapping, data[start:end], metadata)
+            if object_vals:
+                self._deferred_create_objects(
+                    records, object_vals[start:end], metadata)
 
         resource.last_pull = datetime.now()
-        if self.operation != 'pull' or not object_vals:
-            return True
+        return True
 
-        # create external objects and object_links from record
-        record_ids = records.ids
-        model_id = metadata['model_id']
-        object_link = self.env['external.data.object.link']
-        obj_id, foreign_id = foreign_type_id = 0
+    @api.model
+    def _deferred_insert_objects(self, vals, data, object_vals, metadata):
+        """Inserts the missing external objects of a queued pull before
+        creating records, so that only the worker inserting an object
+        creates its record. Returns the values of the records to create."""
+        ext_objects = self.env['external.data.object']
+        object_index = metadata['external_object_index']
+        keep = []
         for i, o_vals in enumerate(object_vals):
-            if (
-                o_vals['foreign_id'] != foreign_id or
-                o_vals['foreign_type_id'] != foreign_type_id
-            ):
-                obj_id = ext_objects.create(o_vals).id
-            foreign_id = o_vals['foreign_id']
-            foreign_type_id = o_vals['foreign_type_id']
-
-            object_link.create({
-                'model_id': model_id,
-                'record_id': record_ids[i],
-                'object_ids': [Command.link(obj_id)],
+            object_key = (o_vals['foreign_type_id'], o_vals['foreign_id'])
+            if object_key not in object_index:
+                ext_object, inserted = ext_objects.insert_or_fetch(o_vals)
+                object_index[object_key] = ext_object.id
+                if not inserted:
+                    continue  # created by a concurrent worker
+            keep.append(i)
+        return (
+            [vals[i] for i in keep],
+            [data[i] for i in keep],
+            [object_vals[i] for i in keep],
+        )
+
+    @api.model
+    def _deferred_create_records(self, model_model, vals, metadata):
+        ext_objects = self.env['external.data.object']
+        for vals_i in vals:
+            ext_objects.resolve_pending_binaries(
+                vals_i, model_model, processed=metadata.get('image_cache'))
+        _logger.info(f"Creating {len(vals)} records in model {model_model}")
+        records = self.env[model_model].create(vals)
+        if metadata.get('stats'):
+            metadata['stats']['created'] += len(records)
+        return records
+
+    @api.model
+    def _deferred_post_process(self, records, field_mapping, data, metadata):
+        """Applies post-processing rules on created records,
+        writes records with identical values at once."""
+        post_rules = field_mapping.rule_ids_post
+        if not post_rules:
+            return
+        ext_objects = self.env['external.data.object']
+        metadata.update({'pre_post': 'post'})
+        writes = {}  # {vals digest: (vals, record IDs)}
+        for record, data_i in zip(records, data):
+            metadata.update({'record': record, 'processed_keys': []})
+            vals = field_mapping.apply_mapping(data_i, metadata)
+            post_rules.apply_rules(vals, metadata)
+            if metadata.pop('drop', False):
+                continue
+            self._prune_vals(vals, **metadata)
+            ext_objects.resolve_pending_binaries(
+                vals, records._name, processed=metadata.get('image_cache'))
+            ext_objects.sanitize_values(vals, **metadata)
+            if vals:
+                vals_hash = payload.vals_digest(vals)
+                writes.setdefault(vals_hash, (vals, []))[1].append(record.id)
+        for vals, record_ids in writes.values():
+            records.browse(record_ids).write(vals)
+
+    @api.model
+    def _deferred_create_objects(self, records, object_vals, metadata):
+        """Creates external objects missing from the object index,
+        and object links of the records."""
+        ext_objects = self.env['external.data.object']
+        object_index = metadata['external_object_index']
+        new_object_vals = {}
+        existing_ids = set()
+        for o_vals in object_vals:
+            object_key = (o_vals['foreign_type_id'], o_vals['foreign_id'])
+            if object_key in object_index:
+                existing_ids.add(object_index[object_key])
+            else:
+                new_object_vals.setdefault(object_key, o_vals)
+        if existing_ids:
+            ext_objects.browse(sorted(existing_ids)).write({
+                'resource_ids': [Command.link(metadata['resource_id'])],
             })
+        new_ids = ext_objects.create(list(new_object_vals.values())).ids
+        object_index.update(zip(new_object_vals, new_ids))
 
-        return True
+        model_id = metadata['model_id']
+        variant_tag = metadata.get('obj_link_variant_tag', False)
+        self.env['external.data.object.link'].create([
+            {
+                'model_id': model_id,
+                'record_id': record.id,
+                'variant_tag': variant_tag,
+                'object_ids': [Command.link(object_index[(
+                    o_vals['foreign_type_id'], o_vals['foreign_id'])])],
+            }
+            for record, o_vals in zip(records, object_vals)
+        ])
 
     def mass_edit(self, field_mapping_id=False, debug=False):
         self.ensure_one()
@@ -547,7 +1087,13 @@ class ExternalDataStrategy(models.Model):
 
         # TODO: paginated resource
         metadata = {}
-        for vals in self._gather_items(metadata=metadata):
+        items = self._gather_items(metadata=metadata)
+        if self.serializer_id.engine == 'csv':
+            # a single document, rendered in chunks while gathering items
+            data = self.serializer_id.serialize(items)
+            result = self.transporter_id.deliver(data)
+            return
+        for vals in items:
             data = self.serializer_id.serialize(vals)
             result = self.transporter_id.deliver(data)
             # TODO: refresh resources, external objects from result
@@ -584,6 +1130,7 @@ class ExternalDataStrategy(models.Model):
             'prune_implicit': prune_implicit,
             'prune_false': mapping.prune_vals,  # TODO: like prune_implicit
         })
+        metadata.setdefault('lookup_cache', {})
         foreign_type = mapping.foreign_type_id
         if foreign_type:
             metadata.update({
@@ -1,7 +1,10 @@
 # coding: utf-8
 
-from requests import Request, Session
+import os
 from odoo import fields, models
+from odoo.tools import config
+
+from ..tools import binary_cache, fetcher, http
 
 import logging
 import warnings
@@ -77,17 +80,105 @@ class ExternalDataTransporter(models.Model):
         ],
         default='binary',
     )
+    streaming = fields.Boolean(
+        "Streaming",
+        help="Return binary content as a file-like stream, "
+        "so the payload doesn't have to be loaded into memory at once.",
+    )
+    http_pool_size = fields.Integer(
+        "Connection pool size",
+        help="Maximum number of connections kept alive per host.",
+        default=10,
+    )
+    http_max_retries = fields.Integer("Max retries", default=3)
+    http_retry_backoff = fields.Float(
+        "Retry backoff",
+        help="Backoff factor in seconds between retries.",
+        default=0.5,
+    )
+    http_keep_alive = fields.Boolean("Keep-alive", default=True)
+    binary_cache = fields.Boolean(
+        "Binary cache",
+        help="Keep binaries fetched by rules in an on-disk cache "
+        "shared by the transporters of the database.",
+    )
+    binary_cache_size = fields.Integer("Cache size (MB)", default=1024)
+    binary_cache_max_age = fields.Integer(
+        "Cache max age (s)",
+        help="Cached binaries younger than this are used without "
+        "revalidation. Older ones are revalidated with conditional "
+        "requests.",
+        default=0,
+    )
+    http_pool_stats = fields.Text(
+        "Connection pool statistics",
+        compute='_compute_http_pool_stats',
+    )
+
+    def _compute_http_pool_stats(self):
+        for record in self:
+            stats = http.session_stats(record._get_session_key())
+            record.http_pool_stats = "\n".join(
+                f"{key}: {value}" for key, value in stats.items())
 
-    def fetch(self, resource_id):
+    def _get_session_key(self):
+        return (self.env.cr.dbname, self.id or False)
+
+    def get_session(self):
+        """Returns the pooled HTTP session of the transporter, shared by
+        all fetches of the process. Called on an empty recordset,
+        returns a default session."""
+        key = self._get_session_key()
+        if not self:
+            return http.get_session(key)
+        self.ensure_one()
+        return http.get_session(
+            key,
+            version=str(self.write_date),
+            pool_size=self.http_pool_size or 1,
+            max_retries=self.http_max_retries,
+            backoff=self.http_retry_backoff,
+            keep_alive=self.http_keep_alive,
+        )
+
+    def fetch(self, resource_id, validators=None):
+        """Returns the payload of a resource.
+        If 'validators' is a dict, HTTP requests are conditional on the
+        cache validators it holds: http.NOT_MODIFIED is returned if the
+        resource is unchanged, otherwise the validators of the response
+        are put in the dict, to be stored on the resource after a
+        successful pull."""
+        request = self.prepare_fetch(resource_id, validators=validators)
+        return fetcher.fetch(request, validators=validators)
+
+    def get_binary_cache(self):
+        """Returns the binary cache of the database if enabled,
+        None otherwise."""
+        if not self:
+            return None
+        self.ensure_one()
+        if not self.binary_cache:
+            return None
+        directory = os.path.join(
+            config['data_dir'], 'external_data_binary_cache',
+            self.env.cr.dbname)
+        return binary_cache.get_cache(
+            directory, self.binary_cache_size * 1024 * 1024,
+            max_age=self.binary_cache_max_age,
+        )
+
+    def prepare_fetch(self, resource_id, validators=None):
+        """Returns a plain request for fetching a resource, executed by
+        tools.fetcher.fetch() out of the ORM, False if not possible."""
         self.ensure_one()
         resource = self.env['external.data.resource'].browse(resource_id)
         if not resource.exists():
             return False
 
         if self.protocol == 'http':
-            return self._fetch_http(resource)
+            return self._prepare_fetch_http(resource, validators=validators)
         elif self.protocol == 'local_fs':
-            return self._fetch_local_fs(resource)
+            return self._prepare_fetch_local_fs(resource)
         else:
             # TODO: raise exception
             return False
@@ -95,28 +186,30 @@ class ExternalDataTransporter(models.Model):
     def deliver(self, resource_id):
         pass
 
-    def _fetch_http(self, resource):
+    def _prepare_fetch_http(self, resource, validators=None):
         self.ensure_one()
-        ses = Session()
-        req = Request(self.http_request_method, resource.url)
-        req_prepped = ses.prepare_request(req)
-        res = ses.send(req_prepped)
-        if res.status_code == 200:
-            if self.content_type == 'binary':
-                return res.content
-            elif self.content_type == 'text':
-                return res.text
-        return False
-
-    def _fetch_local_fs(self, resource):
+        headers = {}
+        if validators:
+            if validators.get('http_etag'):
+                headers['If-None-Match'] = validators['http_etag']
+            if validators.get('http_last_modified'):
+                headers['If-Modified-Since'] = \
+                    validators['http_last_modified']
+        return {
+            'protocol': 'http',
+            'session': self.get_session(),
+            'method': self.http_request_method,
+            'url': resource.url,
+            'headers': headers,
+            'content_type': self.content_type,
+            'stream': self.streaming and self.content_type == 'binary',
+        }
+
+    def _prepare_fetch_local_fs(self, resource):
         self.ensure_one()
-        # TODO: check whether file or directory
-        if self.content_type == 'binary':
-            mode = 'rb'
-        elif self.content_type == 'text':
-            mode = 'r'
-        try:
-            reader = open(resource.url, mode)
-            return reader.read()
-        except Exception as e:
-            _logger.error(e)
+        return {
+            'protocol': 'local_fs',
+            'path': resource.url,
+            'content_type': self.content_type,
+            'stream': self.streaming,
+        }
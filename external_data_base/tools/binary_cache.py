@@ -0,0 +1,192 @@
+# coding: utf-8
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# process-level registry: {directory: BinaryCache}
+_caches = {}
+_lock = threading.Lock()
+
+
+def checksum(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha1(data).hexdigest()
+
+
+def get_cache(directory, max_size, max_age=0):
+    """Returns the cache of a directory, shared by the whole process."""
+    with _lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = BinaryCache(
+                directory, max_size, max_age)
+        else:
+            cache.max_size, cache.max_age = max_size, max_age
+        return cache
+
+
+class BinaryCache:
+    """On-disk cache of fetched binaries.
+    Contents are stored once per checksum, URLs point to them along with
+    their HTTP validators. Least recently used contents are evicted when
+    the cache grows above max_size bytes. Cached URLs are revalidated
+    with conditional requests when older than max_age seconds."""
+
+    def __init__(self, directory, max_size, max_age=0):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._written = None  # bytes written since last eviction
+
+    def fetch(self, url, session):
+        """Returns the content of a URL, from the cache if still valid,
+        None if it can't be fetched."""
+        entry = self._read_entry(url)
+        content = entry and self._read_content(entry['checksum'])
+        headers = {}
+        if content is not None:
+            if time.time() - entry.get('checked', 0) < self.max_age:
+                return content
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            res = session.get(url, headers=headers)
+        except Exception as e:
+            _logger.error(e)
+            return content
+        if res.status_code == 304 and content is not None:
+            entry['checked'] = time.time()
+            self._write_entry(url, entry)
+            return content
+        if res.status_code != 200 or not isinstance(res.content, bytes):
+            _logger.error(f"Failed to fetch {url}: HTTP {res.status_code}")
+            return content
+
+        content = res.content
+        content_checksum = checksum(content)
+        self._write_content(content_checksum, content)
+        self._write_entry(url, {
+            'url': url,
+            'checksum': content_checksum,
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+            'checked': time.time(),
+        })
+        return content
+
+    def _entry_path(self, url):
+        key = checksum(url)
+        return os.path.join(self.directory, 'urls', key[:2], key + '.json')
+
+    def _content_path(self, content_checksum):
+        return os.path.join(
+            self.directory, 'contents', content_checksum[:2],
+            content_checksum)
+
+    def _read_entry(self, url):
+        try:
+            with open(self._entry_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_entry(self, url, entry):
+        self._write_file(self._entry_path(url), json.dumps(entry).encode())
+
+    def _read_content(self, content_checksum):
+        path = self._content_path(content_checksum)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            os.utime(path)  # least recently used are evicted first
+        except OSError:
+            return None
+        return content
+
+    def _write_content(self, content_checksum, content):
+        path = self._content_path(content_checksum)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        self._write_file(path, content)
+        with self._lock:
+            if self._written is not None:
+                self._written += len(content)
+            if self._written is None or self._written > self.max_size // 10:
+                self._evict()
+
+    def _write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        """Removes least recently used contents down to 90% of max_size,
+        along with the URL entries pointing to them."""
+        files = []
+        for root, _dirs, names in os.walk(
+                os.path.join(self.directory, 'contents')):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        size = sum(file_size for _mtime, file_size, _path in files)
+        evicted = False
+        if size > self.max_size:
+            files.sort()
+            for _mtime, file_size, path in files:
+                if size <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= file_size
+                evicted = True
+            _logger.info(f"Binary cache {self.directory} evicted to {size}B")
+        if evicted or self._written is None:
+            # on first run too, for entries left by an interrupted eviction
+            self._evict_entries()
+        self._written = 0
+
+    def _evict_entries(self):
+        """Removes the URL entries whose content is no longer cached."""
+        removed = 0
+        for root, _dirs, names in os.walk(
+                os.path.join(self.directory, 'urls')):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    with open(path) as f:
+                        content_checksum = json.load(f)['checksum']
+                except (OSError, ValueError, KeyError, TypeError):
+                    content_checksum = None
+                if content_checksum and os.path.exists(
+                        self._content_path(content_checksum)):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed += 1
+        if removed:
+            _logger.info(
+                f"Binary cache {self.directory} evicted {removed} URLs")
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+import codecs
+import csv
+from io import BytesIO, StringIO
+
+import logging
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+
+def get_format(options):
+    """Returns the keyword arguments of csv readers and writers."""
+    kwargs = {'dialect': options.get('dialect') or 'excel'}
+    if options.get('delimiter'):
+        kwargs['delimiter'] = options['delimiter']
+    if options.get('quotechar'):
+        kwargs['quotechar'] = options['quotechar']
+    return kwargs
+
+
+def get_encoding(options, decode=False):
+    encoding = codecs.lookup(options.get('encoding') or 'utf-8').name
+    if decode and encoding == 'utf-8':
+        return 'utf-8-sig'  # skip the byte order mark of Excel exports
+    return encoding
+
+
+def iter_lines(source, encoding, chunk_size=CHUNK_SIZE):
+    """Yields the lines of a stream, decoded incrementally. Only '\\n'
+    ends lines: line breaks of quoted values are left to the reader."""
+    decode = codecs.getincrementaldecoder(encoding)().decode
+    pending = ''
+    while True:
+        chunk = source.read(chunk_size)
+        text = decode(chunk, final=not chunk) \
+            if isinstance(chunk, bytes) else chunk
+        if text:
+            lines = (pending + text).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if not chunk:
+            break
+    if pending:
+        yield pending
+
+
+def iter_rows(data, options):
+    """Yields the rows of CSV data read lazily from a stream, bytes or
+    text: dicts by column name if the first row is a header, lists
+    otherwise. Malformed data raises csv.Error or UnicodeDecodeError."""
+    if isinstance(data, str):
+        source = StringIO(data)
+    elif isinstance(data, bytes):
+        source = BytesIO(data)
+    elif hasattr(data, 'read'):
+        if getattr(data, 'seekable', lambda: False)():
+            data.seek(0)
+        source = data
+    else:
+        return
+    lines = iter_lines(source, get_encoding(options, decode=True))
+    try:
+        if options.get('header', True):
+            yield from csv.DictReader(lines, **get_format(options))
+        else:
+            yield from csv.reader(lines, **get_format(options))
+    except (csv.Error, UnicodeDecodeError) as e:
+        # a partial pull would be pruned as if complete
+        _logger.error(e)
+        raise
+
+
+def render_chunks(items, options, chunk_size=1000):
+    """Renders items to CSV, yields encoded chunks of 'chunk_size' rows.
+    Columns are the keys of the first item, with a header row if set."""
+    encoding = get_encoding(options)
+    buffer = StringIO()
+    writer = None
+    rows = 0
+    for item in items:
+        if writer is None:
+            writer = csv.DictWriter(
+                buffer, fieldnames=list(item), extrasaction='ignore',
+                **get_format(options))
+            if options.get('header', True):
+                writer.writeheader()
+        writer.writerow(item)
+        rows += 1
+        if rows >= chunk_size:
+            yield buffer.getvalue().encode(encoding)
+            buffer.seek(0)
+            buffer.truncate()
+            rows = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode(encoding)
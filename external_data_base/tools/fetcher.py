@@ -0,0 +1,196 @@
+# coding: utf-8
+
+import threading
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from requests import Request
+
+from . import http
+
+import logging
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 14
+
+
+def fetch(request, validators=None):
+    """Executes a request prepared by a transporter's prepare_fetch().
+    It doesn't touch the ORM, so it can be run in threads."""
+    if not request:
+        return False
+    if request['protocol'] == 'http':
+        return fetch_http(request, validators=validators)
+    elif request['protocol'] == 'local_fs':
+        return fetch_local_fs(request)
+    return False
+
+
+def fetch_http(request, validators=None):
+    ses = request['session']
+    req = Request(request['method'], request['url'],
+                  headers=request['headers'])
+    res = ses.send(ses.prepare_request(req), stream=request['stream'])
+    if res.status_code == 304:
+        res.close()
+        return http.NOT_MODIFIED
+    if res.status_code == 200:
+        if validators is not None:
+            validators.update({
+                'http_etag': res.headers.get('ETag', False),
+                'http_last_modified': res.headers.get(
+                    'Last-Modified', False),
+            })
+        if request['stream']:
+            res.raw.decode_content = True
+            return ResponseStream(res)
+        elif request['content_type'] == 'binary':
+            return res.content
+        elif request['content_type'] == 'text':
+            return res.text
+    res.close()
+    return False
+
+
+class ResponseStream:
+    """File-like body of a streamed response. Closing it reads what is
+    left of a small body, so the connection goes back to the pool of
+    the session instead of being discarded."""
+    drain_limit = 1 << 16
+
+    def __init__(self, response):
+        self.response = response
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        return self.response.raw.read(size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            drained = 0
+            while drained <= self.drain_limit:
+                chunk = self.response.raw.read(CHUNK_SIZE)
+                if not chunk:
+                    break  # fully read, the connection is released
+                drained += len(chunk)
+        except Exception as e:
+            _logger.debug(e)
+        finally:
+            self.response.close()
+
+
+def fetch_local_fs(request):
+    # TODO: check whether file or directory
+    if request['content_type'] == 'binary':
+        mode = 'rb'
+    elif request['content_type'] == 'text':
+        mode = 'r'
+    try:
+        reader = open(request['path'], mode)
+    except Exception as e:
+        _logger.error(e)
+        return None
+    if request['stream'] and mode == 'rb':
+        return reader
+    with reader:
+        return reader.read()
+
+
+def prefetch(items, workers=4, ahead=4):
+    """Fetches (key, request, validators) items in a thread pool,
+    yields (key, future, validators) in order, keeping at most 'ahead'
+    items fetched in advance. Items are consumed lazily, in the calling
+    thread, so they can be prepared using the ORM."""
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        try:
+            for key, request, validators in items:
+                future = executor.submit(fetch, request, validators)
+                pending.append((key, future, validators))
+                if len(pending) > ahead:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            for _key, future, _validators in pending:
+                future.cancel()
+
+
+class PendingBinary:
+    """Placeholder of a binary being fetched by a BinaryFetcher."""
+    __slots__ = ('url', 'future', 'encode')
+
+    def __init__(self, url, future, encode=True):
+        self.url = url
+        self.future = future
+        self.encode = encode
+
+    def __repr__(self):
+        return f"PendingBinary({self.url!r})"
+
+    def result(self):
+        """Waits for the content, returns None if the fetch failed."""
+        content = self.future.result()
+        if content is None or not self.encode:
+            return content
+        return b64encode(content)
+
+
+class BinaryFetcher:
+    """Fetches binaries of a run in a thread pool, each URL once,
+    with a bounded number of concurrent requests per host.
+    If a BinaryCache is given, binaries are fetched through it."""
+
+    def __init__(self, session, workers=8, per_host=2, cache=None):
+        self.session = session
+        self.cache = cache
+        self.per_host = max(per_host, 1)
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._futures = {}
+        self._hosts = {}
+
+    def submit(self, url, encode=True):
+        """Starts fetching a URL, returns a PendingBinary."""
+        future = self._futures.get(url)
+        if future is None:
+            host = urlsplit(url).netloc
+            semaphore = self._hosts.get(host)
+            if semaphore is None:
+                semaphore = self._hosts[host] = \
+                    threading.BoundedSemaphore(self.per_host)
+            future = self._futures[url] = self._executor.submit(
+                self._fetch, url, semaphore)
+        return PendingBinary(url, future, encode=encode)
+
+    def _fetch(self, url, semaphore):
+        with semaphore:
+            if self.cache is not None:
+                return self.cache.fetch(url, self.session)
+            try:
+                res = self.session.get(url)
+            except Exception as e:
+                _logger.error(e)
+                return None
+        if isinstance(res.content, bytes):
+            return res.content
+        return None
+
+    def clear(self):
+        """Forgets fetched URLs, so their content can be released."""
+        self._futures.clear()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._futures.clear()
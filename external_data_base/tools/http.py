@@ -0,0 +1,82 @@
+# coding: utf-8
+
+import threading
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# returned by fetches instead of the payload if the resource is unchanged
+NOT_MODIFIED = object()
+
+# process-level pool: {key: (version, session)}
+_sessions = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+def get_session(key, version=None, pool_size=10, max_retries=0,
+                backoff=0, keep_alive=True):
+    """Returns the pooled session of key, a new one is created
+    if missing or its version (configuration) has changed."""
+    with _lock:
+        stats = _stats.setdefault(key, {'hits': 0, 'misses': 0})
+        entry = _sessions.get(key)
+        if entry and entry[0] == version:
+            stats['hits'] += 1
+            return entry[1]
+
+        stats['misses'] += 1
+        if entry:
+            entry[1].close()
+        session = new_session(pool_size, max_retries, backoff, keep_alive)
+        _sessions[key] = (version, session)
+        return session
+
+
+def new_session(pool_size=10, max_retries=0, backoff=0, keep_alive=True):
+    session = Session()
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def session_stats(key):
+    """Returns the counters of a pooled session:
+    session hits/misses, and requests/connections of its connection pools.
+    Connection pool hit rate is the ratio of requests on reused connections.
+    """
+    with _lock:
+        stats = dict(_stats.get(key, {'hits': 0, 'misses': 0}))
+        entry = _sessions.get(key)
+
+    requests = connections = 0
+    if entry:
+        for adapter in set(entry[1].adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools[pool_key]
+                requests += pool.num_requests
+                connections += pool.num_connections
+    stats.update({
+        'requests': requests,
+        'connections': connections,
+        'pool_hit_rate': (
+            round(1 - connections / requests, 4) if requests else 0.0),
+    })
+    return stats
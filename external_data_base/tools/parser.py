@@ -0,0 +1,729 @@
+# coding: utf-8
+
+import codecs
+import json
+import re
+from functools import partial
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+import jmespath
+from bs4 import BeautifulSoup
+from bs4 import element as bs_element
+from odoo.exceptions import ValidationError
+from odoo.tools import etree
+
+from . import bs
+from . import csv as csv_tools
+from . import payload
+from . import xlsx as xlsx_tools
+from .jmespath import options as jmespath_options
+
+import logging
+_logger = logging.getLogger(__name__)
+
+GENERATOR_PATH_TYPES = (
+    'elementpath', 'findall', 'css_findall', 'jmespath_items', 'csv_rows',
+    'sheet_rows',
+)
+JSON_STREAMING_PATHS = ('[*]', '[]', '@')
+JSON_CHUNK_SIZE = 1 << 16
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+
+class Directive:
+    """Compiled parser directive.
+    Holds the values of a parser line and its children as plain Python
+    objects, precomputed for the engine, so parsing doesn't touch the ORM.
+    """
+    __slots__ = (
+        'id', 'engine', 'streaming', 'foreign_type_id', 'field_name',
+        'path_type', 'path', 'extract_method', 'extract_param',
+        'children', 'is_generator',
+        # lxml.etree
+        'lxml_path', 'lxml_tag', 'local_name',
+        # JSON
+        'json_expression',
+        # CSV
+        'column',
+        # BeautifulSoup
+        'bs_name', 'bs_attrs', 'bs_attrs_not', 'bs_recursive',
+        'index', 'start', 'end',
+    )
+
+    def __init__(self, id, engine, foreign_type_id, path_type, path,
+                 field_name=None, extract_method=None, extract_param=None,
+                 streaming=False, children=()):
+        values = {
+            'id': id,
+            'engine': engine,
+            'streaming': streaming,
+            'foreign_type_id': foreign_type_id,
+            'field_name': field_name,
+            'path_type': path_type,
+            'path': path,
+            'extract_method': extract_method,
+            'extract_param': extract_param,
+            'children': tuple(children),
+            'is_generator': path_type in GENERATOR_PATH_TYPES,
+            # ignore namespace
+            # TODO: add option to it
+            'lxml_path': "{*}" + path,
+            'lxml_tag': "{*}" + path.rstrip('/').split('/')[-1],
+            'local_name': path.rstrip('/').split('/')[-1],
+            'json_expression': (
+                self._compile_jmespath(id, path)
+                if engine == 'json' else None),
+            # column index if numeric, name otherwise
+            'column': int(path) if path.strip().isdigit() else path,
+        }
+        values.update(self._compile_bs(path, path_type, extract_method,
+                                       extract_param))
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Compiled directives are read-only")
+
+    def __repr__(self):
+        return f"Directive({self.id}, {self.path_type!r}, {self.path!r})"
+
+    @staticmethod
+    def _compile_jmespath(id, path):
+        try:
+            return jmespath.compile(path)
+        except jmespath.exceptions.ParseError as e:
+            _logger.error(f"Parse rule (ID {id}): {e}")
+            return None
+
+    @staticmethod
+    def _compile_bs(path, path_type, extract_method, extract_param):
+        name = None
+        attrs = dict(parse_qsl(path))
+        if not attrs:
+            name = path
+        attrs_not = {}
+        for key in list(attrs):
+            if key[0] == '-':
+                attrs_not[key[1:]] = attrs.pop(key)
+        index = start = end = None
+        if extract_method == 'index' and extract_param:
+            index_split = extract_param.split(':')
+            if len(index_split) == 2:
+                start = bs.get_index(index_split[0])
+                end = bs.get_index(index_split[1])
+            else:
+                index = bs.get_index(extract_param)
+        return {
+            'bs_name': name,
+            'bs_attrs': attrs,
+            'bs_attrs_not': attrs_not,
+            'bs_recursive': path_type == 'children',
+            'index': index,
+            'start': start,
+            'end': end,
+        }
+
+
+def rewind(stream):
+    """Seeks to the start of a stream if possible. Streams of the
+    network or a decompressor can be read only once."""
+    if payload.seekable(stream):
+        stream.seek(0)
+
+
+def prepare(data, engine):
+    if engine == 'lxml_etree':
+        return prepare_lxml_etree(data)
+    if engine == 'bs':
+        return prepare_bs(data)
+    if engine == 'json':
+        return prepare_json(data)
+    raise ValidationError("Engine is not supported yet")
+
+
+def prepare_lxml_etree(data):
+    if isinstance(data, etree._Element):
+        return data
+    elif hasattr(data, 'read'):
+        rewind(data)
+        try:
+            return etree.parse(data).getroot()
+        except Exception as e:
+            _logger.error(e)
+            return None
+
+    if isinstance(data, (str, bytes)):
+        try:
+            return etree.fromstring(data)
+        except Exception as e:
+            _logger.error(e)
+            return None
+    return None
+
+
+def prepare_bs(data):
+    if isinstance(data, (BeautifulSoup, bs_element.Tag)):
+        return data
+    elif hasattr(data, 'read'):
+        rewind(data)
+
+    if isinstance(data, (str, bytes)) or hasattr(data, 'read'):
+        try:
+            return BeautifulSoup(data, features="lxml")
+        except Exception as e:
+            _logger.error(e)
+            return None
+    return None
+
+
+def prepare_json(data):
+    if isinstance(data, (dict, list)):
+        return data
+    try:
+        if hasattr(data, 'read'):
+            rewind(data)
+            return json.load(data)
+        if isinstance(data, (str, bytes)):
+            return json.loads(data)
+    except ValueError as e:
+        _logger.error(e)
+    return None
+
+
+class DocumentContext:
+    """Parse-once context of a payload.
+    The payload is prepared once for the directives of all foreign types
+    and the engine specific functions are chosen once, so executing a
+    directive on an element doesn't check types or parse again."""
+
+    def __init__(self, engine, raw_data, streaming=False, options=None):
+        self._iterparse = None
+        if engine == 'lxml_etree':
+            self._prepare, self._execute = \
+                prepare_lxml_etree, execute_lxml_etree
+            self._iterparse = iterparse_lxml_etree
+            self._native_types = document_types = (etree._Element,)
+        elif engine == 'bs':
+            self._prepare, self._execute = prepare_bs, execute_bs
+            self._native_types = document_types = \
+                (BeautifulSoup, bs_element.Tag)
+        elif engine == 'json':
+            self._prepare, self._execute = prepare_json, execute_json
+            self._iterparse = iterparse_json
+            document_types = (dict, list)
+            # values extracted from a JSON document are never parsed again
+            self._native_types = (object,)
+        elif engine == 'csv':
+            # rows are always read lazily by the generator directives
+            self._prepare, self._execute = None, execute_csv
+            self._iterparse = partial(iterparse_csv, options=options or {})
+            document_types = ()
+            self._native_types = (object,)
+            streaming = True
+        elif engine == 'xlsx':
+            # rows are always read lazily by the generator directives
+            self._prepare, self._execute = None, execute_csv
+            self._iterparse = partial(iterparse_xlsx, options=options or {})
+            document_types = ()
+            self._native_types = (object,)
+            streaming = True
+            raw_data = xlsx_tools.get_source(raw_data)
+        else:
+            raise ValidationError("Engine is not supported yet")
+        self.engine = engine
+        self._stream = None
+        if streaming and self._iterparse and \
+                not isinstance(raw_data, document_types):
+            # parsed by the generator directives
+            self._stream = self.root = raw_data
+        else:
+            self.root = self._prepare(raw_data)
+
+    def prepare(self, data):
+        """Parses raw data extracted by a directive, e.g. with 'tostring',
+        returns elements and documents as they are."""
+        if data is None or isinstance(data, self._native_types):
+            return data
+        return self._prepare(data)
+
+    def execute(self, directive, data):
+        """Executes a directive on prepared data."""
+        if data is None:
+            return None
+        if data is self._stream:
+            return self._iterparse(directive, data)
+        return self._execute(directive, data)
+
+    def traversal_key(self, directive, source):
+        """Returns the key of the traversal a generator directive runs
+        on its source, generators with the same key share traversals.
+        Streamed payloads are parsed once for all the tags, lxml
+        'findall' directives on the same element iterate it once."""
+        if source is self._stream and self.engine == 'xlsx':
+            return ('iterparse', directive.path)  # one per worksheet
+        elif source is self._stream:
+            return ('iterparse',)
+        if self.engine == 'lxml_etree' and directive.path_type == 'findall'\
+                and '/' not in directive.path:
+            return ('iter', id(source))
+        return (
+            'execute', id(source), directive.path_type, directive.path,
+            directive.extract_method, directive.extract_param,
+        )
+
+    def traverse(self, key, directives, source):
+        """Returns the elements of a traversal shared by directives."""
+        if key[0] == 'iterparse' and self.engine in ('json', 'csv', 'xlsx'):
+            return self._iterparse(directives[0], source)
+        elif key[0] == 'iterparse':
+            tags = list(dict.fromkeys(d.lxml_tag for d in directives))
+            iter_source = iterparse_source(source)
+            if iter_source is None:
+                return None
+            return iterparse_elements(iter_source, tags)
+        elif key[0] == 'iter':
+            return source.iter(*dict.fromkeys(d.lxml_path for d in directives))
+        return self.execute(directives[0], source)
+
+    def element_name(self, key, element):
+        """Returns the name routing an element of a shared traversal to
+        the directives with the same local name, None if the element is
+        meant for all the directives."""
+        if key[0] == 'execute' or self.engine != 'lxml_etree':
+            return None
+        return etree.QName(element).localname
+
+
+def execute(directive, data):
+    """Executes a single directive on raw or prepared data."""
+    context = DocumentContext(
+        directive.engine, data, streaming=directive.streaming)
+    return context.execute(directive, context.root)
+
+
+def execute_lxml_etree(directive, data):
+    if data is None:
+        return None
+    path_type = directive.path_type
+    if path_type == 'xpath':
+        chunk = data.xpath(directive.lxml_path)
+    elif path_type == 'elementpath':
+        chunk = data.iterfind(directive.lxml_path)
+    elif path_type == 'find':
+        chunk = data.find(directive.lxml_path)
+    elif path_type == 'findall':
+        chunk = data.iter(directive.lxml_path)
+    else:
+        return None
+    return extract_lxml_etree(directive, chunk)
+
+
+def extract_lxml_etree(directive, chunk):
+    if chunk is None:
+        return None
+
+    extract_method = directive.extract_method
+    if extract_method == 'attr' and directive.extract_param:
+        return chunk.get(directive.extract_param)
+
+    if directive.extract_param:
+        chunk = chunk.find(directive.extract_param)
+
+    if extract_method == 'text':
+        return chunk.text
+    elif extract_method == 'tag':
+        return chunk.tag
+    elif extract_method == 'tostring':
+        return etree.tostring(chunk)
+    else:
+        return chunk
+
+
+def iterparse_lxml_etree(directive, data):
+    """Returns a generator of the elements matching the last step
+    of the path, parsed incrementally from the raw data."""
+    if not directive.is_generator:
+        _logger.warning(
+            f"Parse rule (ID {directive.id}) is not a generator, "
+            "not supported at top level in streaming mode."
+        )
+        return None
+    source = iterparse_source(data)
+    if source is None:
+        return None
+    return iterparse_elements(source, directive.lxml_tag)
+
+
+def iterparse_source(data):
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, bytes):
+        return BytesIO(data)
+    elif hasattr(data, 'read'):
+        rewind(data)
+        return data
+    return None
+
+
+def iterparse_elements(source, tag):
+    """Yields elements by tag (or a list of tags) while parsing.
+    When the consumer is done with an outermost matching element, the
+    element and its preceding siblings get cleared, so the tree in memory
+    stays small. Matching elements nested in it are kept until then."""
+    context = etree.iterparse(source, events=('start', 'end'), tag=tag)
+    depth = 0
+    try:
+        for event, element in context:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            yield element
+            if depth:
+                continue
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    except etree.XMLSyntaxError as e:
+        # truncated payloads must not pass for complete ones
+        _logger.error(e)
+        raise
+    finally:
+        del context
+
+
+def execute_json(directive, data):
+    expression = directive.json_expression
+    if expression is None:
+        return None
+    chunk = expression.search(data, options=jmespath_options)
+    if chunk is None:
+        return None
+    if directive.is_generator:
+        if not isinstance(chunk, list):
+            chunk = [chunk]
+        return iter(chunk)
+    return extract_json(directive, chunk)
+
+
+def extract_json(directive, chunk):
+    extract_method = directive.extract_method
+    if extract_method == 'attr' and directive.extract_param:
+        if not isinstance(chunk, dict):
+            return None
+        return chunk.get(directive.extract_param)
+    elif extract_method == 'text':
+        return chunk if isinstance(chunk, str) else json.dumps(chunk)
+    elif extract_method == 'tostring':
+        return json.dumps(chunk)
+    elif extract_method == 'list':
+        return chunk if isinstance(chunk, list) else [chunk]
+    else:
+        return chunk
+
+
+def iterparse_json(directive, data):
+    """Returns a generator of the items of a toplevel array decoded
+    incrementally from the raw data. Only generator directives
+    projecting the root array, e.g. '[*]', are supported."""
+    if not directive.is_generator or \
+            directive.path.strip() not in JSON_STREAMING_PATHS:
+        _logger.warning(
+            f"Parse rule (ID {directive.id}) doesn't project the toplevel "
+            "array, not supported at top level in streaming mode."
+        )
+        return None
+    source = iterparse_source(data)
+    if source is None:
+        return None
+    return iterdecode_array(source)
+
+
+def iterdecode_array(source, chunk_size=JSON_CHUNK_SIZE):
+    """Yields the items of a toplevel JSON array one by one, reading and
+    decoding the source in chunks, so only the current item is held in
+    memory. Raises ValueError on malformed or truncated payloads, so an
+    incomplete feed never looks like a successful pull."""
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8-sig')().decode
+    buffer, pos, eof = '', 0, False
+
+    def more():
+        """Reads the next chunk, returns False at EOF. A chunk may decode
+        to nothing, e.g. a partial multibyte sequence."""
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        chunk = source.read(chunk_size)
+        if not chunk:
+            eof = True
+        if isinstance(chunk, bytes):
+            chunk = decode(chunk, final=eof)
+        buffer, pos = buffer[pos:] + chunk, 0
+        return not eof
+
+    def next_char():
+        """Skips whitespace, returns the next character, '' at EOF."""
+        nonlocal pos
+        while True:
+            match = JSON_WHITESPACE.match(buffer, pos)
+            pos = match.end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if not more():
+                return ''
+
+    if next_char() != '[':
+        raise ValueError("JSON payload is not an array")
+    pos += 1
+    if next_char() == ']':
+        return
+    while True:
+        next_char()
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if more():
+                continue
+            raise
+        if not eof and JSON_NUMBER_TAIL.fullmatch(buffer, end) and \
+                isinstance(item, (int, float)) and more():
+            continue  # the number may go on in the next chunk
+        pos = end
+        yield item
+        char = next_char()
+        if char == ']':
+            return
+        elif char != ',':
+            raise ValueError(f"Unexpected {char or 'EOF'!r} in JSON array")
+        pos += 1
+
+
+def execute_csv(directive, row):
+    """Extracts a column of a CSV or worksheet row, by name from rows
+    with a header, by index otherwise. Missing and blank cells are
+    extracted as False, so they are written as empty values."""
+    if directive.path_type != 'column':
+        return None
+    column = directive.column
+    if isinstance(row, dict):
+        if isinstance(column, int):
+            row = list(row.values())
+        else:
+            return extract_csv(directive, row.get(column))
+    if not isinstance(column, int):
+        return None
+    try:
+        return extract_csv(directive, row[column])
+    except IndexError:
+        return extract_csv(directive, None)
+
+
+def extract_csv(directive, value):
+    if value is None:
+        return False
+    extract_method = directive.extract_method
+    if extract_method == 'text':
+        return value.strip() if isinstance(value, str) else str(value)
+    elif extract_method == 'list':
+        return [value]
+    return value
+
+
+def iterparse_csv(directive, data, options):
+    """Returns a generator of the rows of a CSV read lazily."""
+    if directive.path_type != 'csv_rows':
+        _logger.warning(
+            f"Parse rule (ID {directive.id}) doesn't generate rows, "
+            "not supported at top level with CSV."
+        )
+        return None
+    return csv_tools.iter_rows(data, options)
+
+
+def iterparse_xlsx(directive, data, options):
+    """Returns a generator of the rows of a worksheet read lazily."""
+    if directive.path_type != 'sheet_rows':
+        _logger.warning(
+            f"Parse rule (ID {directive.id}) doesn't generate rows, "
+            "not supported at top level with XLSX."
+        )
+        return None
+    return xlsx_tools.iter_rows(data, options, sheet_name=directive.path)
+
+
+def execute_bs(directive, data):
+    if data is None:
+        return None
+
+    path_type = directive.path_type
+    name, attrs, attrs_not = \
+        directive.bs_name, directive.bs_attrs, directive.bs_attrs_not
+    index, start, end = directive.index, directive.start, directive.end
+    if path_type == 'find':
+        if index:
+            try:
+                chunk = data.find_all(name=name, attrs=attrs)[index]
+            except IndexError:
+                return None
+        else:
+            chunk = data.find(name=name, attrs=attrs)
+    elif path_type in ['next', 'prev']:
+        gen = bs.findall(data, name, attrs, attrs_not, direction=path_type)
+        try:
+            chunk = next(gen)
+        except StopIteration:
+            return None
+    elif path_type in ['children', 'findall']:
+        chunk = bs.findall(data, name, attrs, attrs_not,
+                           recursive=directive.bs_recursive,
+                           start=start, end=end)
+    elif path_type == 'css_find':
+        if index:
+            chunk = data.select(directive.path)[index]
+        else:
+            chunk = data.select_one(directive.path)
+    elif path_type == 'css_findall':
+        if start or end:
+            chunk = data.select(directive.path)[start:end]
+        else:
+            chunk = data.select(directive.path)
+        if not chunk:
+            return None
+        chunk = (e for e in chunk)
+    else:
+        return None
+
+    if attrs_not and isinstance(chunk, bs_element.Tag):
+        if not bs.compute_conditions(chunk, attrs_not=attrs_not):
+            return None
+    return extract_bs(directive, chunk)
+
+
+def extract_bs(directive, chunk):
+    if chunk is None:
+        return None
+
+    extract_method = directive.extract_method
+    if extract_method == 'attr' and directive.extract_param:
+        return chunk.get(directive.extract_param)
+
+    if directive.extract_param:
+        chunk = chunk.find(directive.extract_param)
+
+    if extract_method == 'text':
+        return chunk.string.strip()
+    elif extract_method == 'tag':
+        return chunk.name
+    elif extract_method == 'tostring':
+        return str(chunk)
+    elif extract_method == 'list':
+        if isinstance(chunk, (int, str)):
+            return [chunk]
+        elif isinstance(chunk, list):
+            return chunk
+        else:
+            return None
+    else:
+        return chunk
+
+
+def get_object_data(context, directives, foreign_type_id, data,
+                    vals, generator=None, gen_directive=None, defer=False):
+    """Returns the vals extracted by the directives, the generator and
+    its directive. With 'defer', generator directives are not executed,
+    the data they would run on is returned as generator instead."""
+    for directive in directives:
+        if directive.foreign_type_id != foreign_type_id:
+            continue
+
+        if defer and directive.is_generator:
+            new_data = data
+        else:
+            new_data = context.execute(directive, data)
+        if new_data is None:
+            msg = f"Parse rule (ID {directive.id}) execution returned no data"
+            _logger.debug(msg)
+            continue
+
+        if directive.is_generator:
+            if generator is not None:
+                _logger.warning(
+                    "Multiple generator found for an object type "
+                    "at the same level. Returning the last one only."
+                )
+            generator = new_data
+            gen_directive = directive
+        elif directive.children:
+            vals, generator, gen_directive = get_object_data(
+                context, directive.children, foreign_type_id,
+                context.prepare(new_data), vals, defer=defer,
+            )
+        elif directive.field_name and directive.extract_method:
+            vals[directive.field_name] = new_data
+    return vals, generator, gen_directive
+
+
+def object_data_generator(context, directives, foreign_type_id, data, vals,
+                          jmespath_expr=()):
+    """Yields the object data of a foreign type. Elements yielded by
+    generator directives are passed to their children as they are,
+    each starting from a copy of the values extracted so far, so values
+    of an element never leak into the next one."""
+    vals, generator, gen_directive = get_object_data(
+        context, directives, foreign_type_id, data, vals,
+    )
+    if generator is not None and gen_directive is not None:
+        for child_data in generator:
+            yield from object_data_generator(
+                context, gen_directive.children, foreign_type_id,
+                child_data, vals.copy(), jmespath_expr=jmespath_expr,
+            )
+    else:
+        yield rearrange(vals, jmespath_expr)
+
+
+def rearrange(vals, jmespath_expr=()):
+    # rearrange by starting with an empty new dict
+    vals_parsed = {}
+    for expr in jmespath_expr:
+        parsed = expr(vals)
+        if parsed:
+            vals_parsed.update(parsed)
+    return vals_parsed or vals
+
+
+def merged_object_data(context, plan, jmespath_expr=()):
+    """Yields (foreign type ID, object data) pairs of all the foreign types
+    of a plan, in document order. Toplevel generators running the same
+    traversal are executed once and each element they yield is routed
+    to the child directives of every foreign type matching it."""
+    traversals = {}  # {key: (source, [(foreign type ID, directive, vals)])}
+    for foreign_type_id, directives in plan.items():
+        vals, source, gen_directive = get_object_data(
+            context, directives, foreign_type_id, context.root, {},
+            defer=True,
+        )
+        if gen_directive is None:
+            yield foreign_type_id, rearrange(vals, jmespath_expr)
+            continue
+        key = context.traversal_key(gen_directive, source)
+        traversals.setdefault(key, (source, []))[1].append(
+            (foreign_type_id, gen_directive, vals))
+
+    for key, (source, routes) in traversals.items():
+        directives = [directive for _, directive, _ in routes]
+        elements = context.traverse(key, directives, source)
+        if elements is None:
+            continue
+        for element in elements:
+            name = context.element_name(key, element)
+            for foreign_type_id, directive, vals in routes:
+                if name is not None and name != directive.local_name:
+                    continue
+                for child_vals in object_data_generator(
+                        context, directive.children, foreign_type_id,
+                        element, vals.copy(), jmespath_expr=jmespath_expr):
+                    yield foreign_type_id, child_vals
@@ -0,0 +1,84 @@
+# coding: utf-8
+
+import gzip
+import hashlib
+import json
+from tempfile import SpooledTemporaryFile
+
+CHUNK_SIZE = 1 << 16
+SPOOL_MAX_SIZE = 1 << 24
+
+
+def fingerprint(data, chunk_size=CHUNK_SIZE):
+    """Returns the hex digest of a payload and the payload to go on with.
+    File-like payloads are hashed in chunks and returned rewound,
+    non-seekable streams are spooled to a temporary file and closed."""
+    digest = hashlib.sha256()
+    if isinstance(data, str):
+        digest.update(data.encode())
+        return digest.hexdigest(), data
+    elif isinstance(data, (bytes, bytearray)):
+        digest.update(data)
+        return digest.hexdigest(), data
+    elif not hasattr(data, 'read'):
+        return False, data
+
+    spool = None if seekable(data) else SpooledTemporaryFile(SPOOL_MAX_SIZE)
+    while True:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        digest.update(chunk)
+        if spool is not None:
+            spool.write(chunk)
+    if spool is None:
+        data.seek(0)
+        return digest.hexdigest(), data
+    data.close()
+    spool.seek(0)
+    return digest.hexdigest(), spool
+
+
+def seekable(data):
+    """Returns whether a stream can be rewound. Gzip files claim to be
+    seekable, but rewind by seeking the file they decompress."""
+    if isinstance(data, gzip.GzipFile):
+        return seekable(data.fileobj)
+    return hasattr(data, 'seekable') and data.seekable()
+
+
+def spool(data, chunk_size=CHUNK_SIZE):
+    """Returns a payload that can be read more than once: non-seekable
+    streams are spooled to a temporary file and closed, other payloads
+    are returned as they are."""
+    if not hasattr(data, 'read') or seekable(data):
+        return data
+    spooled = SpooledTemporaryFile(SPOOL_MAX_SIZE)
+    while True:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        spooled.write(chunk)
+    data.close()
+    spooled.seek(0)
+    return spooled
+
+
+def vals_digest(vals):
+    """Returns the hex digest of a vals dict, independent of key order.
+    Binary values are hashed as is, others by their JSON representation."""
+    digest = hashlib.sha256()
+    for key in sorted(vals):
+        value = vals[key]
+        digest.update(key.encode() + b'\0')
+        if isinstance(value, (bytes, bytearray)):
+            digest.update(value)
+        else:
+            digest.update(
+                json.dumps(value, sort_keys=True, default=str).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
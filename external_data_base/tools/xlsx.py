@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import zipfile
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+
+from odoo.exceptions import UserError
+
+from .payload import CHUNK_SIZE, SPOOL_MAX_SIZE, seekable
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+def get_source(data):
+    """Returns a seekable file of a workbook: workbooks are zip files,
+    read from the end. Non-seekable streams are spooled to a temporary
+    file and closed."""
+    if isinstance(data, bytes):
+        return BytesIO(data)
+    elif not hasattr(data, 'read'):
+        return None
+    elif seekable(data):
+        return data
+    spool = SpooledTemporaryFile(SPOOL_MAX_SIZE)
+    while True:
+        chunk = data.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        spool.write(chunk)
+    data.close()
+    spool.seek(0)
+    return spool
+
+
+def iter_rows(source, options, sheet_name='*'):
+    """Yields the non-empty rows of a worksheet, the first one if
+    'sheet_name' is '*', read lazily in read-only mode: dicts by column
+    name if the first row is a header, lists otherwise.
+    Invalid workbooks and missing worksheets raise a UserError."""
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise UserError("The openpyxl library is required to parse XLSX")
+    if source is None:
+        return
+    source.seek(0)
+    try:
+        workbook = load_workbook(source, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, KeyError, ValueError) as e:
+        _logger.error(e)
+        raise UserError(f"Invalid XLSX workbook: {e}") from e
+    try:
+        if sheet_name == '*':
+            worksheet = workbook.worksheets[0]
+        elif sheet_name in workbook.sheetnames:
+            worksheet = workbook[sheet_name]
+        else:
+            raise UserError(f"Missing worksheet {sheet_name}")
+        rows = worksheet.iter_rows(values_only=True)
+        header = None
+        if options.get('header', True):
+            header = next(rows, None)
+            if header is None:
+                return
+            header = [
+                str(name).strip() if name is not None else ''
+                for name in header
+            ]
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            yield dict(zip(header, row)) if header else list(row)
+    finally:
+        workbook.close()